@@ -6,11 +6,18 @@ Shared configuration for electricity monitoring scripts
 # Graphite/Carbon server settings
 CARBON_SERVER = '192.168.86.123'
 CARBON_PORT = 2003
+# Carbon pickle receiver, used by the Tuya pollers' persistent connection
+# (one binary frame per batch). Set to None to use the plaintext port.
+CARBON_PICKLE_PORT = 2004
 
 # Polling intervals (seconds)
 SMART_PLUG_POLL_INTERVAL = 10
 METER_POLL_INTERVAL = 5
 
+# Tuya local: unchanged metrics are re-sent at least every N polls rather
+# than every poll (power_watts is always sent; see tuya_local_to_graphite).
+METRIC_KEEPALIVE_POLLS = 60
+
 # Metric naming prefix
 METRIC_PREFIX = 'home.electricity'
 
@@ -80,6 +87,9 @@ GRAPHITE_FETCH_TAIL_LINES = 720  # Last hour at 5s resolution
 KASA_REDISCOVERY_INTERVAL = 180  # 3 minutes - detect new devices/IP changes
 TUYA_REDISCOVERY_INTERVAL = 180  # 3 minutes
 
+# Max concurrent Tuya local status() calls (dedicated thread pool size)
+TUYA_POLL_WORKERS = 8
+
 # --------------------------------------------------------------
 # Optional per-host overrides
 # --------------------------------------------------------------
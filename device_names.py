@@ -24,7 +24,7 @@ DEVICE_NAMES_FILE = os.path.join(_SCRIPT_DIR, 'device_names.json')
 
 # Cache to avoid re-reading file on every call and to preserve data on errors
 _cached_names: Optional[Dict[str, str]] = None
-_cache_mtime: float = 0
+_cache_mtime: int = 0  # st_mtime_ns of the file the cache was loaded from
 
 
 def load_device_names() -> Dict[str, str]:
@@ -37,17 +37,16 @@ def load_device_names() -> Dict[str, str]:
     """
     global _cached_names, _cache_mtime
     
-    # Check if file exists
-    if not os.path.exists(DEVICE_NAMES_FILE):
-        if _cached_names is not None:
-            return _cached_names.copy()
-        return {}
-    
-    # Check if file has changed since last read
+    # Check if file has changed since last read (one stat; integer ns mtime
+    # so the comparison is exact)
     try:
-        current_mtime = os.path.getmtime(DEVICE_NAMES_FILE)
+        current_mtime = os.stat(DEVICE_NAMES_FILE).st_mtime_ns
         if _cached_names is not None and current_mtime == _cache_mtime:
             return _cached_names.copy()
+    except FileNotFoundError:
+        if _cached_names is not None:
+            return _cached_names.copy()
+        return {}
     except OSError as e:
         logger.warning(f"Could not stat device names file: {e}")
         if _cached_names is not None:
@@ -131,7 +130,7 @@ def save_device_names(names: Dict[str, str]) -> bool:
             
             # Update cache
             _cached_names = clean_names
-            _cache_mtime = os.path.getmtime(DEVICE_NAMES_FILE)
+            _cache_mtime = os.stat(DEVICE_NAMES_FILE).st_mtime_ns
             
             return True
         except Exception:
@@ -4,10 +4,14 @@ Shared helper functions for sending metrics to Graphite/Carbon server
 Based on patterns from ~/scripts/graphite_temperatures.py
 """
 
+import asyncio
+import pickle
 import socket
+import struct
 import time
 import logging
-from typing import List, Tuple, Optional
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -67,8 +71,317 @@ def send_metrics(server: str, port: int, metrics: List[Tuple[str, float]], times
         return 0
 
 
+def _plaintext_payload(metrics: List[Tuple[str, float]], timestamp: int) -> bytes:
+    """Encode metrics for Carbon's line receiver ("name value timestamp\\n")."""
+    return ''.join(f"{name} {value} {timestamp}\n" for name, value in metrics).encode()
+
+
+def _pickle_payload(metrics: List[Tuple[str, float]], timestamp: int) -> bytes:
+    """Encode metrics as one length-prefixed frame for Carbon's pickle receiver."""
+    payload = pickle.dumps([(name, (timestamp, value)) for name, value in metrics], protocol=2)
+    return struct.pack('!L', len(payload)) + payload
+
+
+def send_metrics_pickle(server: str, port: int, metrics: List[Tuple[str, float]], timestamp: Optional[int] = None) -> int:
+    """Send multiple metrics using Carbon's pickle protocol. Returns count sent."""
+    if timestamp is None:
+        timestamp = int(time.time())
+    
+    if not metrics:
+        return 0
+    
+    try:
+        sock = socket.socket()
+        sock.settimeout(5)
+        sock.connect((server, port))
+        sock.sendall(_pickle_payload(metrics, timestamp))
+        sock.close()
+        
+        logger.info(f"Successfully sent {len(metrics)} metrics (pickle)")
+        return len(metrics)
+        
+    except socket.error as exc:
+        logger.error(f"Socket error sending metrics: {exc}")
+        return 0
+    except Exception as exc:
+        logger.error(f"Unexpected error sending metrics: {exc}")
+        return 0
+
+
+# Linux TCP_CORK / BSD TCP_NOPUSH: coalesce a batch into full-sized segments
+_TCP_CORK: Optional[int] = getattr(socket, 'TCP_CORK', None) or getattr(socket, 'TCP_NOPUSH', None)
+
+
+class CarbonUnavailable(ConnectionError):
+    """Carbon could not take a batch; retry_at is the time.monotonic() of the next attempt."""
+
+    def __init__(self, message: str, retry_at: float):
+        super().__init__(message)
+        self.retry_at = retry_at
+
+
+class CarbonClient:
+    """Persistent connection to Carbon (plaintext or pickle protocol).
+
+    The connection is an asyncio stream opened lazily and kept for the life
+    of the process, so each poll cycle costs one write rather than a fresh
+    TCP handshake, and a slow Carbon applies backpressure through drain()
+    instead of tying up a worker thread. On any error the connection is
+    dropped; reconnects back off exponentially. While waiting to reconnect
+    send() drops batches and send_or_raise() raises CarbonUnavailable.
+    With use_pickle=True, port must be Carbon's pickle receiver and each
+    batch is sent as a single pickle frame.
+    """
+
+    RECONNECT_DELAY_MIN = 1.0
+    RECONNECT_DELAY_MAX = 60.0
+
+    def __init__(self, server: str, port: int, timeout: float = 5.0, use_pickle: bool = False):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.use_pickle = use_pickle
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._reconnect_delay = 0.0
+        self._reconnect_at = 0.0
+
+    def _bind_loop(self) -> asyncio.Lock:
+        """Reset per-loop state if we are now running under a different event loop."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            if self._writer is not None:
+                try:
+                    self._writer.transport.abort()
+                except RuntimeError:  # previous loop already closed
+                    pass
+            self._reader = self._writer = None
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _connect(self) -> None:
+        async with asyncio.timeout(self.timeout):
+            self._reader, self._writer = await asyncio.open_connection(self.server, self.port)
+        sock = self._writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._reconnect_delay = 0.0
+        logger.debug(f"Connected to Carbon at {self.server}:{self.port}")
+
+    def _peer_closed(self) -> bool:
+        """Carbon never writes to us, so EOF on the reader means it hung up."""
+        return self._writer.is_closing() or self._reader.at_eof()
+
+    def _cork(self, on: bool) -> None:
+        """Hold back partial segments while a batch is written; uncorking flushes it."""
+        if _TCP_CORK is None or self._writer is None:
+            return
+        sock = self._writer.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, int(on))
+        except OSError:
+            pass
+
+    def _schedule_reconnect(self) -> None:
+        self._reconnect_delay = min(
+            max(self._reconnect_delay * 2, self.RECONNECT_DELAY_MIN), self.RECONNECT_DELAY_MAX
+        )
+        self._reconnect_at = time.monotonic() + self._reconnect_delay
+
+    async def close(self) -> None:
+        """Close the connection; the next send reconnects."""
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def send(self, metrics: List[Tuple[str, float]], timestamp: Optional[int] = None) -> int:
+        """Send metrics over the persistent connection. Returns count sent.
+
+        If Carbon is unavailable the batch is dropped and 0 is returned; use
+        send_or_raise (or a CarbonSendQueue) to keep it for a retry.
+        """
+        try:
+            return await self.send_or_raise(metrics, timestamp)
+        except CarbonUnavailable as exc:
+            logger.warning(f"{exc}; dropping {len(metrics)} metrics")
+            return 0
+
+    async def send_or_raise(self, metrics: List[Tuple[str, float]], timestamp: Optional[int] = None) -> int:
+        """Like send(), but raise CarbonUnavailable instead of dropping the batch."""
+        if not metrics:
+            return 0
+        if timestamp is None:
+            timestamp = int(time.time())
+        encode = _pickle_payload if self.use_pickle else _plaintext_payload
+        payload = encode(metrics, timestamp)
+
+        async with self._bind_loop():
+            if self._writer is not None and self._peer_closed():
+                logger.info("Carbon connection closed by peer; reconnecting")
+                await self.close()
+            if self._writer is None and time.monotonic() < self._reconnect_at:
+                raise CarbonUnavailable("Carbon reconnect backing off", self._reconnect_at)
+            try:
+                if self._writer is None:
+                    await self._connect()
+                self._cork(True)
+                try:
+                    self._writer.write(payload)
+                    async with asyncio.timeout(self.timeout):
+                        await self._writer.drain()
+                finally:
+                    self._cork(False)
+            except (OSError, TimeoutError) as exc:
+                logger.error(f"Socket error sending metrics: {exc!r}")
+                await self.close()
+                self._schedule_reconnect()
+                raise CarbonUnavailable("Carbon connection failed", self._reconnect_at) from exc
+
+        logger.debug(f"Sent {len(metrics)} metrics over persistent Carbon connection")
+        return len(metrics)
+
+
+class MetricDeduper:
+    """Suppress metrics whose value has not changed since they were last sent.
+
+    A metric is emitted when its value moves by more than eps, or when
+    keepalive polls have passed since it was last emitted, which bounds
+    how stale Graphite's last point can get. Call start_poll() once per
+    poll cycle before querying should_emit().
+    """
+
+    def __init__(self):
+        self._poll = 0
+        self._last: Dict[str, Tuple[float, int]] = {}
+
+    def start_poll(self) -> None:
+        self._poll += 1
+
+    def should_emit(self, name: str, value: float, keepalive: int = 60, eps: float = 1e-3) -> bool:
+        last = self._last.get(name)
+        if last is not None:
+            last_value, emitted_at = last
+            if abs(value - last_value) <= eps and self._poll - emitted_at < keepalive:
+                return False
+        self._last[name] = (value, self._poll)
+        return True
+
+
+class CarbonSendQueue:
+    """Buffer metrics for a CarbonClient and send them from a single task.
+
+    put() never waits, so pollers are not held up by a slow or unreachable
+    Carbon; run() drains the queue in batches of up to batch_size metrics
+    (one send per distinct timestamp in the batch). While Carbon is down the
+    current batch is retried once the client's reconnect back-off expires
+    and new metrics keep queueing; they are only dropped, with a warning,
+    once the queue holds maxsize metrics.
+    """
+
+    def __init__(self, client: CarbonClient, maxsize: int = 10000, batch_size: int = 500):
+        self.client = client
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    def put(self, metrics: List[Tuple[str, float]], timestamp: int) -> int:
+        """Queue metrics without blocking. Returns how many were queued."""
+        queued = 0
+        try:
+            for name, value in metrics:
+                self._queue.put_nowait((timestamp, name, value))
+                queued += 1
+        except asyncio.QueueFull:
+            logger.warning(f"Carbon send queue full; dropping {len(metrics) - queued} metrics")
+        return queued
+
+    async def _send_until_accepted(self, metrics: List[Tuple[str, float]], timestamp: int) -> None:
+        """Send one batch, waiting out reconnect back-off until Carbon takes it."""
+        while True:
+            try:
+                await self.client.send_or_raise(metrics, timestamp)
+                return
+            except CarbonUnavailable as exc:
+                delay = exc.retry_at - time.monotonic()
+                logger.warning(f"{exc}; holding {len(metrics)} metrics "
+                               f"({self._queue.qsize()} queued), retrying in {max(delay, 0):.0f}s")
+                await asyncio.sleep(max(delay, 0))
+
+    async def run(self) -> None:
+        """Send queued metrics forever."""
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            by_timestamp: Dict[int, List[Tuple[str, float]]] = {}
+            for timestamp, name, value in batch:
+                by_timestamp.setdefault(timestamp, []).append((name, value))
+            try:
+                for timestamp, metrics in by_timestamp.items():
+                    await self._send_until_accepted(metrics, timestamp)
+            except Exception as exc:
+                # Not a connection problem (e.g. an unencodable value);
+                # retrying would wedge the queue, so drop this batch.
+                logger.error(f"Failed to send queued metrics to Graphite: {exc}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def join(self) -> None:
+        """Wait until everything queued so far has been handed to the client."""
+        await self._queue.join()
+
+
+_carbon_clients: Dict[Tuple[str, int, bool], CarbonClient] = {}
+
+
+def get_carbon_client(server: str, port: int, pickle_port: Optional[int] = None) -> CarbonClient:
+    """Get the shared CarbonClient for a server.
+
+    If pickle_port is given, the client speaks the pickle protocol to that
+    port; otherwise it uses the plaintext protocol on port.
+    """
+    use_pickle = pickle_port is not None
+    key = (server, pickle_port if use_pickle else port, use_pickle)
+    client = _carbon_clients.get(key)
+    if client is None:
+        client = _carbon_clients[key] = CarbonClient(server, key[1], use_pickle=use_pickle)
+    return client
+
+
+# Tracebacks from the pollers' main-loop handlers are rate-limited so a
+# sustained failure (e.g. Carbon down) logs one stack per minute, not one
+# per poll. Tracked per logger so pollers sharing a process don't mask
+# each other.
+TRACEBACK_INTERVAL = 60.0
+_last_traceback: Dict[str, float] = {}
+
+
+def log_loop_error(log: logging.Logger, message: str, exc: Exception) -> None:
+    """Log a main-loop error, with a traceback at most once per TRACEBACK_INTERVAL per logger."""
+    now = time.monotonic()
+    if now - _last_traceback.get(log.name, float('-inf')) > TRACEBACK_INTERVAL:
+        _last_traceback[log.name] = now
+        log.error(f"{message}: {exc}", exc_info=True)
+    else:
+        log.error(f"{message}: {exc}")
+
+
+@lru_cache(maxsize=256)
 def format_device_name(name: str) -> str:
-    """Normalize device name to a lowercase_underscored metric path segment."""
+    """Normalize device name to a lowercase_underscored metric path segment.
+
+    Results are memoized: device names are stable across polls, so each
+    distinct name is only normalized once per process.
+    """
     name = name.lower().replace(' ', '_').replace('-', '_')
     name = ''.join(c for c in name if c.isalnum() or c == '_')
     while '__' in name:
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+JSON helpers shared by the pollers
+Uses orjson when it is installed and falls back to the stdlib json module,
+so callers get the same bytes-in/bytes-out interface either way.
+"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; stdlib json is fine for small fleets
+    orjson = None
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+
+    def json_loads_lenient(payload: Any) -> Any:
+        """orjson.loads, retried with stdlib json for input orjson rejects."""
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (no NaN, 64-bit ints); let stdlib have a go
+            return json.loads(payload)
+else:
+    json_loads = json.loads
+    json_loads_lenient = json.loads
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
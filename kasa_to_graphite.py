@@ -16,6 +16,8 @@ import sys
 import time
 import logging
 import argparse
+import itertools
+import random
 import socket
 import subprocess
 import re
@@ -28,7 +30,7 @@ except ImportError:
     sys.exit(1)
 
 import config
-from graphite_helper import send_metrics, format_device_name
+from graphite_helper import send_metrics, format_device_name, log_loop_error
 from device_names import get_device_name
 
 # Set up logging
@@ -245,8 +247,10 @@ async def get_device_metrics(device: Device, retries: int = 3) -> List[Tuple[str
             
         except (asyncio.TimeoutError, ConnectionResetError, OSError) as e:
             if attempt < retries:
-                wait_time = min(2 ** attempt, 10)  # Exponential backoff, max 10s
-                logger.warning(f"{device_id} update failed ({attempt}/{retries}): {e}. Retrying in {wait_time}s...")
+                # Exponential backoff, max 10s, with +/-20% jitter so plugs that
+                # failed together (e.g. a router blip) don't retry in lockstep
+                wait_time = min(2 ** attempt, 10) * random.uniform(0.8, 1.2)
+                logger.warning(f"{device_id} update failed ({attempt}/{retries}): {e}. Retrying in {wait_time:.1f}s...")
                 await asyncio.sleep(wait_time)
             else:
                 logger.error(f"{device_id} failed after {retries} attempts: {e}")
@@ -272,16 +276,17 @@ async def poll_devices_once(devices: Dict[str, Device]) -> int:
         logger.warning("No devices to poll")
         return 0
     
+    # One timestamp for the whole cycle so Graphite sees a coherent snapshot
+    timestamp = int(time.time())
+    
     # Poll all devices concurrently with isolated error handling
     tasks = [get_device_metrics(device) for device in devices.values()]
     results = await asyncio.gather(*tasks, return_exceptions=True)
     
-    all_metrics = []
+    all_metrics = list(itertools.chain.from_iterable(r for r in results if isinstance(r, list)))
     for result in results:
         if isinstance(result, Exception):
             logger.error(f"Device polling task error: {result}")
-        elif isinstance(result, list):
-            all_metrics.extend(result)
     
     if not all_metrics:
         logger.warning("No metrics collected from any device")
@@ -289,7 +294,7 @@ async def poll_devices_once(devices: Dict[str, Device]) -> int:
     
     # Send all metrics to Graphite
     try:
-        count = send_metrics(config.CARBON_SERVER, config.CARBON_PORT, all_metrics)
+        count = send_metrics(config.CARBON_SERVER, config.CARBON_PORT, all_metrics, timestamp)
         logger.info(f"Sent {count} metrics to Graphite")
         return count
     except Exception as e:
@@ -316,20 +321,27 @@ async def main_loop():
     last_discovery = time.time()
     discovery_interval = getattr(config, "KASA_REDISCOVERY_INTERVAL", 180)  # Re-discover every N minutes
     failed_polls = 0  # Track consecutive failed polls
+    # Re-discovery runs in the background so a 10s+ scan never delays a
+    # poll; its result is swapped in on the first iteration after it ends.
+    discovery_task: Optional[asyncio.Task] = None
     
     try:
         while True:
             try:
+                if discovery_task is not None and discovery_task.done():
+                    task, discovery_task = discovery_task, None
+                    devices = task.result()
+                    failed_polls = 0
+                
                 # Poll devices if we have any
                 if devices:
                     metrics_sent = await poll_devices_once(devices)
                     if metrics_sent == 0:
                         failed_polls += 1
                         # If we haven't sent metrics in 3 polls, try rediscovering
-                        if failed_polls >= 3:
+                        if failed_polls >= 3 and discovery_task is None:
                             logger.warning(f"No metrics sent for {failed_polls} polls - triggering rediscovery")
-                            devices = await discover_devices(devices)
-                            failed_polls = 0
+                            discovery_task = asyncio.create_task(discover_devices(devices))
                             last_discovery = time.time()
                     else:
                         failed_polls = 0  # Reset counter on successful poll
@@ -337,20 +349,22 @@ async def main_loop():
                     logger.warning("No devices available to poll")
                 
                 # Re-discover devices periodically
-                if time.time() - last_discovery >= discovery_interval:
+                if time.time() - last_discovery >= discovery_interval and discovery_task is None:
                     logger.info("Re-discovering devices (periodic scan)...")
-                    devices = await discover_devices(devices)  # Pass prev_devices as fallback
-                    failed_polls = 0
+                    discovery_task = asyncio.create_task(discover_devices(devices))  # Pass prev_devices as fallback
                     last_discovery = time.time()
                 
             except Exception as e:
-                logger.error(f"Error in main loop iteration: {e}", exc_info=True)
+                log_loop_error(logger, "Error in main loop iteration", e)
             
             # Sleep until next poll
             await asyncio.sleep(config.SMART_PLUG_POLL_INTERVAL)
             
     except KeyboardInterrupt:
         logger.info("Shutting down...")
+    finally:
+        if discovery_task is not None:
+            discovery_task.cancel()
 
 
 async def discover_and_print():
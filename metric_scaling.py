@@ -20,10 +20,12 @@ Usage:
     power_watts = scaler.normalize_by_code(device_id, "cur_power", raw_value, product_id=product_id)
 """
 
-import json
 import logging
 import os
-from typing import Any, Dict, Optional
+import pickle
+from typing import Any, Dict, Optional, Tuple
+
+from json_helper import json_loads
 
 logger = logging.getLogger(__name__)
 
@@ -91,6 +93,80 @@ DEFAULT_SCALES: Dict[str, int] = {
 # Current is special: raw value is in mA, we want amps
 CURRENT_MA_TO_AMPS_DIVISOR = 1000.0
 
+# Default location of the per-device mapping file
+DEVICES_JSON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "devices.json")
+
+
+def _to_float(raw_value: Any) -> Optional[float]:
+    """Convert a raw reading to float, or None if it is not numeric.
+
+    Plain ints and floats (what devices almost always report) skip the
+    try/except path.
+    """
+    value_type = type(raw_value)
+    if value_type is float:
+        return raw_value
+    if value_type is int:
+        return float(raw_value)
+    try:
+        return float(raw_value)
+    except (TypeError, ValueError):
+        return None
+
+
+# 10 ** scale for the scales devices actually report
+_POW10: Tuple[float, ...] = tuple(10.0 ** n for n in range(8))
+
+
+def _apply_scale(val: float, scale: int, canonical_code: Optional[str]) -> float:
+    """Apply a 10**scale divisor, converting current from mA to amps."""
+    divisor = _POW10[scale] if 0 <= scale < len(_POW10) else 10 ** scale
+    scaled = val / divisor
+    # Special handling: current is in mA, convert to amps
+    if canonical_code == 'cur_current':
+        scaled = scaled / CURRENT_MA_TO_AMPS_DIVISOR
+    return scaled
+
+
+# (scales_by_device, product_by_device) as built from devices.json
+_ParsedDevices = Tuple[Dict[str, Dict[str, Dict[str, Any]]], Dict[str, str]]
+
+
+def _parse_devices(devices: Any) -> _ParsedDevices:
+    """Extract per-device DPS scales and product IDs from devices.json content."""
+    scales_by_device: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    product_by_device: Dict[str, str] = {}
+    
+    for device in devices:
+        device_id = device.get('id')
+        if not device_id:
+            continue
+        
+        # Track product_id for each device
+        product_id = device.get('product_id')
+        if product_id:
+            product_by_device[device_id] = product_id
+        
+        # Load explicit mapping if present
+        mapping = device.get('mapping', {})
+        if not isinstance(mapping, dict):
+            continue
+        
+        scales_by_device[device_id] = {}
+        for dps_id, dps_info in mapping.items():
+            if not isinstance(dps_info, dict):
+                continue
+            
+            code = dps_info.get('code')
+            values = dps_info.get('values', {})
+            if isinstance(values, dict) and 'scale' in values:
+                scales_by_device[device_id][dps_id] = {
+                    'code': code,
+                    'scale': int(values['scale'])
+                }
+    
+    return scales_by_device, product_by_device
+
 
 class MetricScaler:
     """
@@ -102,66 +178,79 @@ class MetricScaler:
     
     def __init__(self, devices_json_path: Optional[str] = None):
         if devices_json_path is None:
-            devices_json_path = os.path.join(os.path.dirname(__file__), "devices.json")
+            devices_json_path = DEVICES_JSON_PATH
         self._devices_json_path = devices_json_path
-        self._devices_json_mtime: float = 0
+        self._devices_json_sig: Optional[Tuple[int, int]] = None
         self._device_scales: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # (device_id, dps_id) -> explicit scale, flattened for one-lookup hits
+        self._scale_by_dps: Dict[Tuple[str, str], int] = {}
         self._product_by_device: Dict[str, str] = {}
         self._reload_if_changed()
     
     def _reload_if_changed(self) -> None:
-        """Reload scales from devices.json if the file has been modified."""
-        if not os.path.exists(self._devices_json_path):
+        """Reload scales from devices.json if its (mtime, size) has changed."""
+        try:
+            st = os.stat(self._devices_json_path)
+        except OSError:
             return
         
         try:
-            current_mtime = os.path.getmtime(self._devices_json_path)
-            if current_mtime == self._devices_json_mtime:
+            sig = (st.st_mtime_ns, st.st_size)
+            if sig == self._devices_json_sig:
                 return
             
-            with open(self._devices_json_path, 'r') as f:
-                devices = json.load(f)
-            
-            scales_by_device: Dict[str, Dict[str, Dict[str, Any]]] = {}
-            product_by_device: Dict[str, str] = {}
-            
-            for device in devices:
-                device_id = device.get('id')
-                if not device_id:
-                    continue
-                
-                # Track product_id for each device
-                product_id = device.get('product_id')
-                if product_id:
-                    product_by_device[device_id] = product_id
-                
-                # Load explicit mapping if present
-                mapping = device.get('mapping', {})
-                if not isinstance(mapping, dict):
-                    continue
-                
-                scales_by_device[device_id] = {}
-                for dps_id, dps_info in mapping.items():
-                    if not isinstance(dps_info, dict):
-                        continue
-                    
-                    code = dps_info.get('code')
-                    values = dps_info.get('values', {})
-                    if isinstance(values, dict) and 'scale' in values:
-                        scales_by_device[device_id][dps_id] = {
-                            'code': code,
-                            'scale': int(values['scale'])
-                        }
+            signature = (self._devices_json_path, st.st_mtime_ns, st.st_size)
+            parsed = self._load_parse_cache(signature)
+            if parsed is None:
+                with open(self._devices_json_path, 'rb') as f:
+                    devices = json_loads(f.read())
+                parsed = _parse_devices(devices)
+                self._save_parse_cache(signature, parsed)
             
+            scales_by_device, product_by_device = parsed
             self._device_scales = scales_by_device
+            self._scale_by_dps = {
+                (device_id, dps_id): dps_info['scale']
+                for device_id, dps_scales in scales_by_device.items()
+                for dps_id, dps_info in dps_scales.items()
+            }
             self._product_by_device = product_by_device
-            self._devices_json_mtime = current_mtime
+            self._devices_json_sig = sig
             logger.info(f"Loaded scaling info for {len(scales_by_device)} devices, "
                        f"{len(product_by_device)} with product_id")
             
         except Exception as e:
             logger.error(f"Error loading devices.json: {e}")
     
+    def _parse_cache_path(self) -> str:
+        """Return the pickle cache path kept alongside devices.json."""
+        directory, filename = os.path.split(self._devices_json_path)
+        stem = os.path.splitext(filename)[0]
+        return os.path.join(directory, f".{stem}_scales.pkl.cache")
+    
+    def _load_parse_cache(self, signature: Tuple[str, int, int]) -> Optional[_ParsedDevices]:
+        """Return the cached parse of devices.json if it matches signature."""
+        try:
+            with open(self._parse_cache_path(), 'rb') as f:
+                cached = pickle.load(f)
+        except Exception:
+            return None
+        if not isinstance(cached, dict) or cached.get('signature') != signature:
+            return None
+        return cached.get('parsed')
+    
+    def _save_parse_cache(self, signature: Tuple[str, int, int], parsed: _ParsedDevices) -> None:
+        """Best-effort atomic write of the parsed devices.json to the pickle cache."""
+        cache_path = self._parse_cache_path()
+        tmp_path = cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'signature': signature, 'parsed': parsed}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            logger.debug(f"Could not write scale cache {cache_path}: {e}")
+    
     def get_scale(self, device_id: str, metric_code: str, 
                   dps_id: Optional[str] = None,
                   product_id: Optional[str] = None) -> Optional[int]:
@@ -190,10 +279,10 @@ class MetricScaler:
             dps_id = CODE_TO_DPS.get(canonical_code)
         
         # 1. Try device-specific scale from devices.json
-        if device_id in self._device_scales and dps_id:
-            dps_info = self._device_scales[device_id].get(dps_id)
-            if dps_info and 'scale' in dps_info:
-                return dps_info['scale']
+        if dps_id:
+            scale = self._scale_by_dps.get((device_id, dps_id))
+            if scale is not None:
+                return scale
         
         # 2. Try product-type default
         if product_id is None:
@@ -245,9 +334,8 @@ class MetricScaler:
         if raw_value is None:
             return None
         
-        try:
-            val = float(raw_value)
-        except (TypeError, ValueError):
+        val = _to_float(raw_value)
+        if val is None:
             logger.warning(f"Non-numeric value for {device_id} DPS {dps_id}: {raw_value}")
             return None
         
@@ -259,13 +347,7 @@ class MetricScaler:
             logger.debug(f"No scale for {device_id} DPS {dps_id}, returning raw")
             return val
         
-        scaled = val / (10 ** scale)
-        
-        # Special handling: current is in mA, convert to amps
-        if metric_code == 'cur_current':
-            scaled = scaled / CURRENT_MA_TO_AMPS_DIVISOR
-        
-        return scaled
+        return _apply_scale(val, scale, metric_code)
     
     def normalize_by_code(self, device_id: str, metric_code: str, raw_value: Any,
                           product_id: Optional[str] = None) -> Optional[float]:
@@ -286,9 +368,8 @@ class MetricScaler:
         if raw_value is None:
             return None
         
-        try:
-            val = float(raw_value)
-        except (TypeError, ValueError):
+        val = _to_float(raw_value)
+        if val is None:
             logger.warning(f"Non-numeric value for {device_id} {metric_code}: {raw_value}")
             return None
         
@@ -300,14 +381,7 @@ class MetricScaler:
             logger.debug(f"No scale for {device_id} {metric_code}, returning raw")
             return val
         
-        scaled = val / (10 ** scale)
-        
-        # Special handling: current is in mA, convert to amps
-        canonical = self._canonical_code(metric_code)
-        if canonical == 'cur_current':
-            scaled = scaled / CURRENT_MA_TO_AMPS_DIVISOR
-        
-        return scaled
+        return _apply_scale(val, scale, self._canonical_code(metric_code))
 
 
 # Module-level singleton for convenience
@@ -52,6 +52,18 @@ class TestLoadDeviceNames:
         assert result == {"id1": "name1"}
 
 
+    def test_reloads_on_sub_second_mtime_change(self, tmp_path):
+        dn.DEVICE_NAMES_FILE = str(tmp_path / "device_names.json")
+        with open(dn.DEVICE_NAMES_FILE, "w") as f:
+            json.dump({"id1": "name1"}, f)
+        os.utime(dn.DEVICE_NAMES_FILE, ns=(1_000_000_000_000, 1_000_000_000_000))
+        assert dn.load_device_names() == {"id1": "name1"}
+        with open(dn.DEVICE_NAMES_FILE, "w") as f:
+            json.dump({"id1": "renamed"}, f)
+        os.utime(dn.DEVICE_NAMES_FILE, ns=(1_000_000_000_001, 1_000_000_000_001))
+        assert dn.load_device_names() == {"id1": "renamed"}
+
+
 class TestSaveDeviceNames:
     def test_saves_and_reloads(self):
         data = {"id1": "my device"}
@@ -1,7 +1,18 @@
-"""Tests for graphite_helper: format_device_name normalization."""
+"""Tests for graphite_helper: format_device_name normalization, CarbonClient, CarbonSendQueue, MetricDeduper, log_loop_error."""
+
+import asyncio
+import logging
+import pickle
+import socket
+import struct
+import time
 
 import pytest
-from graphite_helper import format_device_name
+import graphite_helper
+from graphite_helper import (
+    CarbonClient, CarbonSendQueue, CarbonUnavailable, MetricDeduper, format_device_name, get_carbon_client,
+    log_loop_error,
+)
 
 
 class TestFormatDeviceName:
@@ -31,3 +42,239 @@ class TestFormatDeviceName:
 
     def test_numbers_preserved(self):
         assert format_device_name("plug 2") == "plug_2"
+
+    def test_result_is_cached(self):
+        format_device_name.cache_clear()
+        format_device_name("Kitchen Plug")
+        format_device_name("Kitchen Plug")
+        assert format_device_name.cache_info().hits == 1
+
+
+@pytest.fixture
+def carbon_server():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(4)
+    server.settimeout(2)
+    yield server
+    server.close()
+
+
+def _recv_lines(conn, count):
+    data = b""
+    while data.count(b"\n") < count:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode().splitlines()
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class TestCarbonClient:
+    def test_sends_plaintext_lines(self, carbon_server):
+        async def run():
+            client = CarbonClient(*carbon_server.getsockname())
+            assert await client.send([("a.b", 1.5), ("a.c", 2)], timestamp=100) == 2
+            conn, _ = carbon_server.accept()
+            assert _recv_lines(conn, 2) == ["a.b 1.5 100", "a.c 2 100"]
+            conn.close()
+            await client.close()
+
+        asyncio.run(run())
+
+    def test_reuses_connection(self, carbon_server):
+        async def run():
+            client = CarbonClient(*carbon_server.getsockname())
+            await client.send([("a.b", 1)], timestamp=1)
+            conn, _ = carbon_server.accept()
+            await client.send([("a.b", 2)], timestamp=2)
+            assert _recv_lines(conn, 2) == ["a.b 1 1", "a.b 2 2"]
+            conn.close()
+            await client.close()
+
+        asyncio.run(run())
+
+    def test_reconnects_after_peer_close(self, carbon_server):
+        async def run():
+            client = CarbonClient(*carbon_server.getsockname())
+            await client.send([("a.b", 1)], timestamp=1)
+            conn, _ = carbon_server.accept()
+            conn.close()
+            await asyncio.sleep(0.05)  # let the loop see EOF
+            assert await client.send([("a.b", 2)], timestamp=2) == 1
+            conn2, _ = carbon_server.accept()
+            assert _recv_lines(conn2, 1) == ["a.b 2 2"]
+            conn2.close()
+            await client.close()
+
+        asyncio.run(run())
+
+    def test_connection_refused_backs_off(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        async def run():
+            client = CarbonClient("127.0.0.1", port, timeout=1)
+            assert await client.send([("a.b", 1)]) == 0
+            assert client._reconnect_delay == CarbonClient.RECONNECT_DELAY_MIN
+            # Within the back-off window the batch is dropped without connecting
+            assert await client.send([("a.b", 1)]) == 0
+            assert client._reconnect_delay == CarbonClient.RECONNECT_DELAY_MIN
+            with pytest.raises(CarbonUnavailable) as exc_info:
+                await client.send_or_raise([("a.b", 1)])
+            assert exc_info.value.retry_at == client._reconnect_at
+
+        asyncio.run(run())
+
+    def test_empty_metrics(self):
+        assert asyncio.run(CarbonClient("127.0.0.1", 1).send([])) == 0
+
+    def test_sends_pickle_frame(self, carbon_server):
+        async def run():
+            client = CarbonClient(*carbon_server.getsockname(), use_pickle=True)
+            assert await client.send([("a.b", 1.5), ("a.c", 2)], timestamp=100) == 2
+            conn, _ = carbon_server.accept()
+            (length,) = struct.unpack("!L", _recv_exact(conn, 4))
+            assert pickle.loads(_recv_exact(conn, length)) == [("a.b", (100, 1.5)), ("a.c", (100, 2))]
+            conn.close()
+            await client.close()
+
+        asyncio.run(run())
+
+    @pytest.mark.skipif(not hasattr(socket, "TCP_CORK"), reason="Linux only")
+    def test_uncorked_after_send(self, carbon_server):
+        async def run():
+            client = CarbonClient(*carbon_server.getsockname())
+            await client.send([("a.b", 1)], timestamp=1)
+            sock = client._writer.get_extra_info("socket")
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_CORK) == 0
+            conn, _ = carbon_server.accept()
+            assert _recv_lines(conn, 1) == ["a.b 1 1"]
+            conn.close()
+            await client.close()
+
+        asyncio.run(run())
+
+    def test_survives_new_event_loop(self, carbon_server):
+        client = CarbonClient(*carbon_server.getsockname())
+        assert asyncio.run(client.send([("a.b", 1)], timestamp=1)) == 1
+        assert asyncio.run(client.send([("a.b", 2)], timestamp=2)) == 1
+        for _ in range(2):
+            conn, _ = carbon_server.accept()
+            conn.close()
+
+
+class RecordingClient:
+    def __init__(self):
+        self.sent = []
+
+    async def send_or_raise(self, metrics, timestamp=None):
+        self.sent.append((timestamp, list(metrics)))
+        return len(metrics)
+
+
+class FlakyClient(RecordingClient):
+    """Unavailable for the first `failures` sends, with a short back-off."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    async def send_or_raise(self, metrics, timestamp=None):
+        if self.failures:
+            self.failures -= 1
+            raise CarbonUnavailable("Carbon connection failed", time.monotonic() + 0.01)
+        return await super().send_or_raise(metrics, timestamp)
+
+
+class TestCarbonSendQueue:
+    def _drain(self, queue):
+        async def run():
+            sender = asyncio.create_task(queue.run())
+            await queue.join()
+            sender.cancel()
+
+        asyncio.run(run())
+
+    def test_batches_grouped_by_timestamp(self):
+        client = RecordingClient()
+        queue = CarbonSendQueue(client)
+        assert queue.put([("a", 1.0), ("b", 2.0)], 100) == 2
+        queue.put([("c", 3.0)], 110)
+        self._drain(queue)
+        assert client.sent == [(100, [("a", 1.0), ("b", 2.0)]), (110, [("c", 3.0)])]
+
+    def test_batch_size_caps_each_send(self):
+        client = RecordingClient()
+        queue = CarbonSendQueue(client, batch_size=2)
+        queue.put([("a", 1.0), ("b", 2.0), ("c", 3.0)], 100)
+        self._drain(queue)
+        assert [len(metrics) for _, metrics in client.sent] == [2, 1]
+
+    def test_batch_held_and_retried_while_carbon_down(self):
+        client = FlakyClient(failures=2)
+        queue = CarbonSendQueue(client)
+        queue.put([("a", 1.0)], 100)
+        self._drain(queue)
+        assert client.sent == [(100, [("a", 1.0)])]
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        queue = CarbonSendQueue(RecordingClient(), maxsize=2)
+        assert queue.put([("a", 1.0), ("b", 2.0), ("c", 3.0)], 100) == 2
+
+
+def test_get_carbon_client_pickle_port():
+    plain = get_carbon_client("127.0.0.1", 2003)
+    pickled = get_carbon_client("127.0.0.1", 2003, pickle_port=2004)
+    assert plain is get_carbon_client("127.0.0.1", 2003)
+    assert (plain.port, plain.use_pickle) == (2003, False)
+    assert (pickled.port, pickled.use_pickle) == (2004, True)
+
+
+class TestMetricDeduper:
+    def _emits(self, deduper, value, **kwargs):
+        deduper.start_poll()
+        return deduper.should_emit("a.b", value, **kwargs)
+
+    def test_first_value_emitted(self):
+        assert self._emits(MetricDeduper(), 1.0)
+
+    def test_unchanged_value_suppressed(self):
+        deduper = MetricDeduper()
+        self._emits(deduper, 1.0)
+        assert not self._emits(deduper, 1.0005)
+
+    def test_changed_value_emitted(self):
+        deduper = MetricDeduper()
+        self._emits(deduper, 1.0)
+        assert self._emits(deduper, 1.1)
+
+    def test_keepalive_reemits(self):
+        deduper = MetricDeduper()
+        emitted = [self._emits(deduper, 0.0, keepalive=3) for _ in range(7)]
+        assert emitted == [True, False, False, True, False, False, True]
+
+
+class TestLogLoopError:
+    def test_traceback_rate_limited_per_logger(self, monkeypatch, caplog):
+        monkeypatch.setattr(graphite_helper, "_last_traceback", {})
+        local, cloud = logging.getLogger("test.local"), logging.getLogger("test.cloud")
+        for _ in range(3):
+            log_loop_error(local, "Error in main loop iteration", RuntimeError("boom"))
+        log_loop_error(cloud, "Error in main loop iteration", RuntimeError("boom"))
+        assert [(r.name, r.exc_info is not None) for r in caplog.records] == [
+            ("test.local", True), ("test.local", False), ("test.local", False), ("test.cloud", True),
+        ]
+        assert caplog.records[-1].getMessage() == "Error in main loop iteration: boom"
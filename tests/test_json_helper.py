@@ -0,0 +1,16 @@
+"""Tests for json_helper: orjson/stdlib loads and dumps."""
+
+import math
+
+import pytest
+import json_helper
+
+
+def test_round_trip_bytes():
+    assert json_helper.json_loads(json_helper.json_dumps({"a": [1, 2.5]})) == {"a": [1, 2.5]}
+
+
+def test_lenient_loads_falls_back_to_stdlib_for_nan():
+    pytest.importorskip("orjson")
+    assert json_helper.json_loads_lenient(b'{"dps": {"1": true}}') == {"dps": {"1": True}}
+    assert math.isnan(json_helper.json_loads_lenient('{"v": NaN}')["v"])
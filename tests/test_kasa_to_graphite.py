@@ -1,5 +1,6 @@
-"""Tests for kasa_to_graphite: resolve_device_ip and resolve_mac_to_ip."""
+"""Tests for kasa_to_graphite: resolve_device_ip, resolve_mac_to_ip and the main loop."""
 
+import asyncio
 import subprocess
 import pytest
 import kasa_to_graphite as ktg
@@ -50,3 +51,35 @@ class TestResolveMacToIp:
             raise OSError("arp not found")
         monkeypatch.setattr(subprocess, "run", _raise)
         assert ktg.resolve_mac_to_ip("aa:bb:cc:dd:ee:ff") is None
+
+
+class TestMainLoop:
+    def test_rediscovery_runs_in_background(self, monkeypatch):
+        monkeypatch.setattr(ktg.config, "SMART_PLUG_POLL_INTERVAL", 0.01)
+        monkeypatch.setattr(ktg.config, "KASA_REDISCOVERY_INTERVAL", 0.02)
+        discoveries = []
+        polled = []
+
+        async def fake_discover(prev_devices=None):
+            discoveries.append(prev_devices)
+            if prev_devices is None:
+                return {"10.0.0.1": "old"}
+            await asyncio.sleep(0.1)
+            return {"10.0.0.2": "new"}
+
+        async def fake_poll(devices):
+            polled.append(list(devices.values()))
+            return 1
+
+        monkeypatch.setattr(ktg, "discover_devices", fake_discover)
+        monkeypatch.setattr(ktg, "poll_devices_once", fake_poll)
+
+        async def run():
+            with pytest.raises(TimeoutError):
+                async with asyncio.timeout(0.3):
+                    await ktg.main_loop()
+
+        asyncio.run(run())
+        # Polling carried on with the old set while the slow scan ran
+        assert polled.count(["old"]) >= 5
+        assert ["new"] in polled
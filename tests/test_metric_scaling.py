@@ -1,6 +1,9 @@
 """Tests for MetricScaler: canonical code mapping and normalization."""
 
+import json
+
 import pytest
+import metric_scaling
 from metric_scaling import MetricScaler, CURRENT_MA_TO_AMPS_DIVISOR
 
 
@@ -70,3 +73,75 @@ class TestNormalizeByDps:
 
     def test_none_returns_none(self):
         assert self.scaler.normalize_by_dps('dev1', '19', None) is None
+
+
+class TestParseCache:
+    def _write_devices(self, tmp_path, scale=2):
+        devices = [{
+            "id": "dev1",
+            "product_id": "prod1",
+            "mapping": {"19": {"code": "cur_power", "values": {"scale": scale}}},
+        }]
+        path = tmp_path / "devices.json"
+        path.write_text(json.dumps(devices, indent=scale))
+        return str(path)
+
+    def test_cache_written_alongside_devices_json(self, tmp_path):
+        MetricScaler(devices_json_path=self._write_devices(tmp_path))
+        assert (tmp_path / ".devices_scales.pkl.cache").exists()
+
+    def test_cached_parse_skips_json(self, tmp_path, monkeypatch):
+        path = self._write_devices(tmp_path)
+        MetricScaler(devices_json_path=path)
+
+        def _fail(*a, **kw):
+            raise AssertionError("devices.json should not be re-parsed")
+        monkeypatch.setattr(metric_scaling, "json_loads", _fail)
+
+        scaler = MetricScaler(devices_json_path=path)
+        assert scaler.get_scale("dev1", "cur_power") == 2
+        assert scaler._product_by_device == {"dev1": "prod1"}
+
+    def test_stale_cache_is_ignored(self, tmp_path):
+        MetricScaler(devices_json_path=self._write_devices(tmp_path, scale=2))
+        path = self._write_devices(tmp_path, scale=3)
+        assert MetricScaler(devices_json_path=path).get_scale("dev1", "cur_power") == 3
+
+
+class TestReloadSignature:
+    def test_unchanged_file_is_not_reloaded(self, tmp_path, monkeypatch):
+        path = TestParseCache()._write_devices(tmp_path)
+        scaler = MetricScaler(devices_json_path=path)
+
+        def _fail(*a, **kw):
+            raise AssertionError("unchanged devices.json should not be reloaded")
+        monkeypatch.setattr(scaler, "_load_parse_cache", _fail)
+        assert scaler.get_scale("dev1", "cur_power", dps_id="19") == 2
+
+    def test_missing_file_keeps_defaults(self, tmp_path):
+        scaler = MetricScaler(devices_json_path=str(tmp_path / "missing.json"))
+        assert scaler.get_scale("dev1", "cur_power") == 1
+
+    def test_flat_lookup_matches_mapping(self, tmp_path):
+        scaler = MetricScaler(devices_json_path=TestParseCache()._write_devices(tmp_path, scale=3))
+        assert scaler._scale_by_dps == {("dev1", "19"): 3}
+
+
+class TestToFloat:
+    def test_numeric_types(self):
+        assert metric_scaling._to_float(5) == 5.0
+        assert metric_scaling._to_float(2.5) == 2.5
+        assert metric_scaling._to_float("12") == 12.0
+
+    def test_non_numeric_returns_none(self):
+        assert metric_scaling._to_float("bad") is None
+        assert metric_scaling._to_float([1]) is None
+
+
+class TestApplyScale:
+    def test_table_matches_pow(self):
+        for scale in range(10):
+            assert metric_scaling._apply_scale(12345.0, scale, "cur_power") == 12345.0 / (10 ** scale)
+
+    def test_negative_scale(self):
+        assert metric_scaling._apply_scale(5.0, -1, "cur_power") == 50.0
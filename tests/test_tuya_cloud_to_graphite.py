@@ -0,0 +1,149 @@
+"""Tests for tuya_cloud_to_graphite: device filtering, quota accounting, response parsing."""
+
+import asyncio
+import json
+import pytest
+import tuya_cloud_to_graphite as tcg
+
+
+def _filter(devices):
+    return asyncio.run(tcg._filter_devices_needing_cloud(devices))
+
+
+class TestFilterDevicesNeedingCloud:
+    def test_all_covered_locally_skips_graphite(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_load_recent_local_successes", lambda now: {"a": now, "b": now})
+
+        async def _fail(*a, **kw):
+            raise AssertionError("Graphite should not be queried")
+        monkeypatch.setattr(tcg, "_graphite_has_recent_local_metrics", _fail)
+
+        assert _filter([{"id": "a"}, {"uuid": "b"}]) == []
+
+    def test_only_uncovered_devices_are_probed(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_load_recent_local_successes", lambda now: {"a": now})
+        probed = []
+
+        async def _probe(dev, now):
+            probed.append(dev["id"])
+            return dev["id"] == "b"
+        monkeypatch.setattr(tcg, "_graphite_has_recent_local_metrics", _probe)
+
+        devices = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+        assert _filter(devices) == [{"id": "c"}]
+        assert probed == ["b", "c"]
+
+    def test_empty_input(self):
+        assert _filter([]) == []
+
+
+class TestCurrentMonthKey:
+    def test_format(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_MONTH_KEY_CACHE", (0.0, ""))
+        key = tcg._tuya_cloud_current_month_key()
+        assert len(key) == 7 and key[4] == "-"
+
+    def test_cached_until_rollover(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_MONTH_KEY_CACHE", (tcg.time.time() + 60, "1999-12"))
+        assert tcg._tuya_cloud_current_month_key() == "1999-12"
+
+    def test_recomputed_after_rollover(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_MONTH_KEY_CACHE", (tcg.time.time() - 1, "1999-12"))
+        assert tcg._tuya_cloud_current_month_key() != "1999-12"
+
+    def test_next_month_epoch(self):
+        utc = tcg.datetime.timezone.utc
+        dec = tcg.datetime.datetime(2025, 12, 15, tzinfo=utc)
+        assert tcg._tuya_cloud_next_month_epoch(dec) == tcg.datetime.datetime(2026, 1, 1, tzinfo=utc).timestamp()
+        mar = tcg.datetime.datetime(2026, 3, 31, 23, 59, tzinfo=utc)
+        assert tcg._tuya_cloud_next_month_epoch(mar) == tcg.datetime.datetime(2026, 4, 1, tzinfo=utc).timestamp()
+
+
+class TestNormalizeTuyaResponse:
+    def test_common_result_list(self):
+        resp = {"success": True, "result": [{"code": "cur_power", "value": 123}, {"code": "switch_1", "value": True}]}
+        assert tcg.normalize_tuya_response(resp, "dev") == {"cur_power": 123, "switch_1": True}
+
+    def test_list_items_without_code_are_ignored(self):
+        resp = {"result": [{"value": 1}, "junk", {"code": "cur_voltage", "value": 2300}]}
+        assert tcg.normalize_tuya_response(resp, "dev") == {"cur_voltage": 2300}
+
+    def test_unsuccessful_response_returns_empty(self):
+        resp = {"success": False, "msg": "permission deny", "result": []}
+        assert tcg.normalize_tuya_response(resp, "dev") == {}
+
+    def test_stringified_json(self):
+        resp = '{"result": [{"code": "cur_current", "value": 50}]}'
+        assert tcg.normalize_tuya_response(resp, "dev") == {"cur_current": 50}
+
+    def test_plain_status_dict(self):
+        assert tcg.normalize_tuya_response({"cur_power": 5}, "dev") == {"cur_power": 5}
+
+    def test_empty_response(self):
+        assert tcg.normalize_tuya_response(None, "dev") == {}
+
+
+class TestFilterPollableDevices:
+    def test_keeps_online_metering_devices(self):
+        devices = [{"id": "a", "category": "cz", "online": True}, {"id": "b", "category": "dlq"}]
+        assert tcg._filter_pollable_devices(devices) == devices
+
+    def test_drops_non_metering_categories(self):
+        devices = [{"id": "gw", "category": "wg2"}, {"id": "plug", "category": "cz"}]
+        assert tcg._filter_pollable_devices(devices) == [{"id": "plug", "category": "cz"}]
+
+    def test_drops_offline_devices(self):
+        devices = [{"id": "a", "category": "cz", "online": False}]
+        assert tcg._filter_pollable_devices(devices) == []
+
+    def test_unknown_category_is_kept(self):
+        assert tcg._filter_pollable_devices([{"id": "a"}]) == [{"id": "a"}]
+
+
+class TestCanSpend:
+    @pytest.fixture(autouse=True)
+    def quota_state(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_QUOTA_STATE_FILE", str(tmp_path / "quota.json"))
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_QUOTA_STATE", None)
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_TOKENS", 10.0)
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_QUOTA_LAST_FLUSH", 0.0)
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_QUOTA_DIRTY", False)
+        monkeypatch.setattr(tcg, "_MONTH_ROLLOVER_EPOCH", 0.0)
+
+    def test_spend_consumes_tokens_and_persists_count(self, tmp_path):
+        assert tcg._tuya_cloud_can_spend(3) is True
+        assert tcg._TUYA_CLOUD_TOKENS < 10.0 - 2.9
+        with open(tmp_path / "quota.json") as f:
+            saved = json.load(f)
+        assert saved["api_calls"] == 3
+
+    def test_quota_file_writes_throttled(self, tmp_path, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(tcg.time, "time", lambda: now[0])
+        saves = []
+        monkeypatch.setattr(tcg, "_tuya_cloud_save_quota_state", lambda state: saves.append(state["api_calls"]))
+        assert tcg._tuya_cloud_can_spend(1) is True
+        assert tcg._tuya_cloud_can_spend(1) is True
+        assert saves == [1]
+        now[0] += tcg._TUYA_CLOUD_QUOTA_FLUSH_INTERVAL
+        assert tcg._tuya_cloud_can_spend(1) is True
+        assert saves == [1, 3]
+
+    def test_rate_limited_when_tokens_exhausted(self):
+        assert tcg._tuya_cloud_can_spend(50) is False
+        assert tcg._TUYA_CLOUD_QUOTA_STATE["api_calls"] == 0
+
+    def test_monthly_cap_enforced(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_QUOTA_STATE", {
+            "month": tcg._tuya_cloud_current_month_key(),
+            "api_calls": tcg.TUYA_CLOUD_API_CALLS_PER_MONTH,
+        })
+        assert tcg._tuya_cloud_can_spend(1) is False
+
+    def test_counter_resets_on_new_month(self, monkeypatch):
+        monkeypatch.setattr(tcg, "_TUYA_CLOUD_QUOTA_STATE", {
+            "month": "1999-12",
+            "api_calls": tcg.TUYA_CLOUD_API_CALLS_PER_MONTH,
+        })
+        assert tcg._tuya_cloud_can_spend(1) is True
+        assert tcg._TUYA_CLOUD_QUOTA_STATE["api_calls"] == 1
@@ -0,0 +1,484 @@
+"""Tests for tuya_local_to_graphite: metric plans, DPS extraction, retries, device cache, poll cycle."""
+
+import asyncio
+import socket
+import pytest
+import tuya_local_to_graphite as tlg
+from graphite_helper import MetricDeduper
+from metric_scaling import MetricScaler
+
+
+_mark_local_success = tlg._mark_local_success
+
+
+class FakeDevice:
+    def __init__(self, status):
+        self._status = status
+
+    def status(self):
+        return self._status
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    monkeypatch.setattr(tlg, "get_device_name", lambda device_id, fallback_name=None: f"Plug {device_id}")
+    monkeypatch.setattr(tlg, "_metric_scaler", MetricScaler(devices_json_path="/dev/null"))
+    monkeypatch.setattr(tlg, "_mark_local_success", lambda device_id: None)
+    monkeypatch.setattr(tlg, "_METRIC_PLANS", {})
+    monkeypatch.setattr(tlg, "_deduper", MetricDeduper())
+    monkeypatch.setattr(tlg, "_RETIRED_DEVICES", [])
+
+
+def _metrics(dps):
+    return dict(asyncio.run(tlg.get_device_metrics(FakeDevice({"dps": dps}), "abc", retries=1)))
+
+
+class TestMetricPlan:
+    def test_metric_names_use_friendly_name(self):
+        plan = tlg._build_metric_plan("abc")
+        assert plan.base == "home.electricity.tuya.plug_abc"
+        assert [name for _, name, _ in plan.entries] == [
+            "home.electricity.tuya.plug_abc.is_on",
+            "home.electricity.tuya.plug_abc.power_watts",
+            "home.electricity.tuya.plug_abc.voltage_volts",
+            "home.electricity.tuya.plug_abc.current_amps",
+        ]
+
+    def test_plan_is_cached(self):
+        assert tlg._metric_plan("abc") is tlg._metric_plan("abc")
+
+
+class TestGetDeviceMetrics:
+    def test_standard_dps(self):
+        metrics = _metrics({"1": True, "19": 1234, "20": 2400, "18": 500})
+        assert metrics == {
+            "home.electricity.tuya.plug_abc.is_on": 1,
+            "home.electricity.tuya.plug_abc.power_watts": pytest.approx(123.4),
+            "home.electricity.tuya.plug_abc.voltage_volts": pytest.approx(240.0),
+            "home.electricity.tuya.plug_abc.current_amps": pytest.approx(0.5),
+        }
+
+    def test_power_falls_back_to_dps_4(self):
+        metrics = _metrics({"1": False, "4": 100})
+        assert metrics == {
+            "home.electricity.tuya.plug_abc.is_on": 0,
+            "home.electricity.tuya.plug_abc.power_watts": pytest.approx(10.0),
+        }
+
+    def test_no_dps_returns_empty(self):
+        assert _metrics({}) == {}
+
+
+class FailingDevice(FakeDevice):
+    def __init__(self, error):
+        super().__init__(None)
+        self.error = error
+        self.calls = 0
+        self.closed = 0
+
+    def status(self):
+        self.calls += 1
+        raise self.error
+
+    def close(self):
+        self.closed += 1
+
+
+class ErrorReplyDevice(FailingDevice):
+    """tinytuya reports socket failures as an error dict rather than raising."""
+
+    def status(self):
+        self.calls += 1
+        return {"Error": "Network Error: Unable to Connect", "Err": "901", "Payload": None}
+
+
+class TestRetries:
+    @pytest.fixture(autouse=True)
+    def no_sleep(self, monkeypatch):
+        async def _no_backoff(attempt):
+            pass
+        monkeypatch.setattr(tlg, "_backoff", _no_backoff)
+
+    def test_network_errors_are_retried(self):
+        dev = FailingDevice(ConnectionResetError("reset"))
+        assert asyncio.run(tlg.get_device_metrics(dev, "abc", retries=3)) == []
+        assert dev.calls == 3
+        assert dev.closed == 3
+
+    def test_socket_timeouts_are_retried(self):
+        dev = FailingDevice(socket.timeout("timed out"))
+        assert asyncio.run(tlg.get_device_metrics(dev, "abc", retries=2)) == []
+        assert dev.calls == 2
+
+    def test_error_replies_are_retried(self):
+        dev = ErrorReplyDevice(None)
+        assert asyncio.run(tlg.get_device_metrics(dev, "abc", retries=3)) == []
+        assert dev.calls == 3
+        assert dev.closed == 3
+
+    def test_bad_replies_are_not_retried(self):
+        dev = FailingDevice(ValueError("bad payload"))
+        assert asyncio.run(tlg.get_device_metrics(dev, "abc", retries=3)) == []
+        assert dev.calls == 1
+
+
+class TestBackoff:
+    def test_delay_is_jittered_and_capped(self, monkeypatch):
+        delays = []
+
+        async def _sleep(delay):
+            delays.append(delay)
+        monkeypatch.setattr(tlg.asyncio, "sleep", _sleep)
+        for attempt in (1, 2, 3, 4):
+            asyncio.run(tlg._backoff(attempt))
+        for delay, ceiling in zip(delays, (2.0, 4.0, 8.0, 10.0)):
+            assert ceiling / 2 <= delay <= ceiling
+
+
+class TestDeviceCache:
+    @pytest.fixture(autouse=True)
+    def cache_file(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tlg, "_TUYA_DEVICE_CACHE_FILE", str(tmp_path / "devices_cache.json"))
+        monkeypatch.setattr(tlg, "_DEVICE_FAILURES", {})
+
+    def test_round_trip(self):
+        info = {"abc": {"ip": "10.0.0.2", "key": "k", "version": "3.3"}}
+        tlg._save_device_cache(info)
+        assert tlg._load_device_cache() == info
+
+    def test_missing_file_returns_empty(self):
+        assert tlg._load_device_cache() == {}
+
+    def test_entries_without_ip_are_ignored(self):
+        tlg._save_device_cache({"abc": {"ip": None}, "def": {"ip": "10.0.0.3"}})
+        assert list(tlg._load_device_cache()) == ["def"]
+
+    def test_repeated_failures_evict_device(self):
+        tlg._save_device_cache({"abc": {"ip": "10.0.0.2"}, "def": {"ip": "10.0.0.3"}})
+        for _ in range(tlg._DEVICE_CACHE_MAX_FAILURES - 1):
+            tlg._record_poll_result("abc", False)
+        assert "abc" in tlg._load_device_cache()
+        tlg._record_poll_result("abc", False)
+        assert list(tlg._load_device_cache()) == ["def"]
+
+    def test_success_resets_failure_count(self):
+        tlg._record_poll_result("abc", False)
+        tlg._record_poll_result("abc", True)
+        assert "abc" not in tlg._DEVICE_FAILURES
+
+
+class FakeCarbonClient:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, metrics, timestamp=None):
+        self.sent.append((list(metrics), timestamp))
+        return len(metrics)
+
+
+class TestPollDevicesOnce:
+    def test_one_timestamp_taken_at_poll_start(self, monkeypatch):
+        client = FakeCarbonClient()
+        monkeypatch.setattr(tlg, "get_carbon_client", lambda *args: client)
+        monkeypatch.setattr(tlg, "_record_poll_result", lambda device_id, ok: None)
+        monkeypatch.setattr(tlg.time, "time", lambda: 1000.7)
+        devices = {"abc": FakeDevice({"dps": {"1": True}}), "def": FakeDevice({"dps": {"1": False}})}
+        assert asyncio.run(tlg.poll_devices_once(devices)) == 2
+        assert sorted(len(metrics) for metrics, _ in client.sent) == [1, 1]
+        assert {timestamp for _, timestamp in client.sent} == {1000}
+
+    def test_each_device_sent_without_waiting_for_slowest(self, monkeypatch):
+        client = FakeCarbonClient()
+        monkeypatch.setattr(tlg, "get_carbon_client", lambda *args: client)
+        monkeypatch.setattr(tlg, "_record_poll_result", lambda device_id, ok: None)
+        release = asyncio.Event()
+
+        async def fake_metrics(device, device_id, plan=None):
+            if device_id == "slow":
+                await release.wait()
+            return [(f"x.{device_id}.power_watts", 1.0)]
+
+        async def run():
+            asyncio.get_running_loop().call_later(0.05, release.set)
+            return await tlg.poll_devices_once({"fast": FakeDevice({}), "slow": FakeDevice({})})
+
+        monkeypatch.setattr(tlg, "get_device_metrics", fake_metrics)
+        assert asyncio.run(run()) == 2
+        assert len(client.sent) == 2
+        assert client.sent[0][0] == [("x.fast.power_watts", 1.0)]
+
+    def test_send_queue_used_instead_of_inline_send(self, monkeypatch):
+        client = FakeCarbonClient()
+        monkeypatch.setattr(tlg, "get_carbon_client", lambda *args: client)
+        monkeypatch.setattr(tlg, "_record_poll_result", lambda device_id, ok: None)
+        queued = []
+
+        class FakeQueue:
+            def put(self, metrics, timestamp):
+                queued.extend(metrics)
+                return len(metrics)
+
+        devices = {"abc": FakeDevice({"dps": {"1": True, "19": 10}})}
+        assert asyncio.run(tlg.poll_devices_once(devices, FakeQueue())) == 2
+        assert len(queued) == 2
+        assert client.sent == []
+
+    def test_unchanged_metrics_suppressed_except_power(self, monkeypatch):
+        client = FakeCarbonClient()
+        monkeypatch.setattr(tlg, "get_carbon_client", lambda *args: client)
+        monkeypatch.setattr(tlg, "_record_poll_result", lambda device_id, ok: None)
+        devices = {"abc": FakeDevice({"dps": {"1": True, "19": 0, "20": 2400}})}
+        assert asyncio.run(tlg.poll_devices_once(devices)) == 3
+        assert asyncio.run(tlg.poll_devices_once(devices)) == 1
+        assert [name for name, _ in client.sent[-1][0]] == ["home.electricity.tuya.plug_abc.power_watts"]
+
+
+class AddressedDevice(FakeDevice):
+    def __init__(self, address, version=3.3):
+        super().__init__({})
+        self.address = address
+        self.version = version
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestUdpDiscovery:
+    KEYS = {"abc": {"id": "abc", "key": "k", "name": "Plug"}}
+
+    @pytest.fixture(autouse=True)
+    def cache_file(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(tlg, "_TUYA_DEVICE_CACHE_FILE", str(tmp_path / "devices_cache.json"))
+        monkeypatch.setattr(tlg, "_build_device", lambda dev_id, info: AddressedDevice(info["ip"], float(info["version"])))
+
+    def _apply(self, devices, **info):
+        asyncio.run(tlg._apply_broadcast({"gwId": "abc", "version": "3.3", **info}, devices, asyncio.Lock(), self.KEYS))
+
+    def test_parses_encrypted_broadcast(self):
+        from tinytuya.core import udp_helper
+        packet = udp_helper.encrypt(b'{"ip": "10.0.0.5", "gwId": "abc", "version": "3.3"}', udp_helper.udpkey)
+        assert tlg._parse_broadcast(packet) == {"ip": "10.0.0.5", "gwId": "abc", "version": "3.3"}
+
+    def test_ignores_garbage(self):
+        assert tlg._parse_broadcast(b"not a broadcast") is None
+
+    def test_new_device_added_and_cached(self):
+        devices = {}
+        self._apply(devices, ip="10.0.0.5")
+        assert devices["abc"].address == "10.0.0.5"
+        assert tlg._load_device_cache()["abc"]["key"] == "k"
+
+    def test_new_device_plan_uses_announced_name(self, monkeypatch):
+        names = {}
+
+        def fake_get_device_name(device_id, fallback_name=None):
+            return names.setdefault(device_id, fallback_name or device_id)
+        monkeypatch.setattr(tlg, "get_device_name", fake_get_device_name)
+        devices = {}
+        self._apply(devices, ip="10.0.0.5")
+        assert tlg._METRIC_PLANS["abc"].base == "home.electricity.tuya.plug"
+
+    def test_moved_device_replaced(self):
+        old = AddressedDevice("10.0.0.4")
+        devices = {"abc": old}
+        self._apply(devices, ip="10.0.0.5")
+        assert devices["abc"].address == "10.0.0.5"
+        # Closed only once the poller is between cycles
+        assert not old.closed
+        tlg._close_retired_devices()
+        assert old.closed
+
+    def test_unchanged_device_kept(self):
+        current = AddressedDevice("10.0.0.5")
+        devices = {"abc": current}
+        self._apply(devices, ip="10.0.0.5")
+        assert devices["abc"] is current
+
+    def test_unknown_device_ignored(self):
+        devices = {}
+        asyncio.run(tlg._apply_broadcast({"gwId": "zzz", "ip": "10.0.0.9"}, devices, asyncio.Lock(), self.KEYS))
+        assert devices == {}
+
+
+class TestRefreshDevices:
+    def test_updates_in_place(self, monkeypatch):
+        monkeypatch.setattr(tlg, "_build_devices", lambda info, existing=None: (
+            {dev_id: FakeDevice({}) for dev_id in info}, {}))
+        old = FakeDevice({})
+        devices = {"old": old}
+        asyncio.run(tlg._refresh_devices(devices, asyncio.Lock(), {"abc": {}, "def": {}}))
+        assert sorted(devices) == ["abc", "def"]
+        assert tlg._RETIRED_DEVICES == [old]
+
+    def test_plans_installed_on_event_loop(self, monkeypatch):
+        plans = {"abc": tlg._build_metric_plan("abc")}
+        monkeypatch.setattr(tlg, "_build_devices", lambda info, existing=None: ({"abc": FakeDevice({})}, plans))
+        asyncio.run(tlg._refresh_devices({}, asyncio.Lock(), {"abc": {}}))
+        assert tlg._METRIC_PLANS is plans
+
+    def test_unchanged_devices_reused(self):
+        lock = asyncio.Lock()
+        info = {"abc": {"ip": "10.0.0.2", "key": "k", "version": "3.3"},
+                "def": {"ip": "10.0.0.3", "key": "k", "version": "3.3"}}
+        devices = {}
+        asyncio.run(tlg._refresh_devices(devices, lock, info))
+        before = dict(devices)
+        info["def"] = {**info["def"], "ip": "10.0.0.4"}
+        asyncio.run(tlg._refresh_devices(devices, lock, info))
+        assert devices["abc"] is before["abc"]
+        assert devices["def"] is not before["def"]
+        assert devices["def"].address == "10.0.0.4"
+
+    def test_session_key_does_not_force_rebuild(self):
+        lock = asyncio.Lock()
+        info = {"abc": {"ip": "10.0.0.2", "key": "0123456789abcdef", "version": "3.4"}}
+        devices = {}
+        asyncio.run(tlg._refresh_devices(devices, lock, info))
+        before = devices["abc"]
+        # A v3.4 handshake replaces local_key with the session key.
+        before.local_key = b"sessionkey012345"
+        asyncio.run(tlg._refresh_devices(devices, lock, info))
+        assert devices["abc"] is before
+
+    def test_empty_scan_keeps_devices(self, monkeypatch):
+        async def empty_scan():
+            return {}
+        monkeypatch.setattr(tlg, "scan_for_devices", empty_scan)
+        devices = {"old": FakeDevice({})}
+        asyncio.run(tlg._refresh_devices(devices, asyncio.Lock()))
+        assert list(devices) == ["old"]
+
+
+class TestPollForever:
+    def _run(self, monkeypatch, answered):
+        failures = {}
+
+        async def fake_poll(devices, send_queue=None):
+            for dev_id in devices:
+                if answered:
+                    failures.pop(dev_id, None)
+                else:
+                    failures[dev_id] = failures.get(dev_id, 0) + 1
+            return 0  # nothing sent, e.g. every metric deduplicated
+
+        monkeypatch.setattr(tlg, "poll_devices_once", fake_poll)
+        monkeypatch.setattr(tlg, "_DEVICE_FAILURES", failures)
+        monkeypatch.setattr(tlg.config, "SMART_PLUG_POLL_INTERVAL", 0.001)
+        rescan = asyncio.Event()
+
+        async def run():
+            with pytest.raises(TimeoutError):
+                async with asyncio.timeout(0.05):
+                    await tlg._poll_forever({"abc": FakeDevice({})}, asyncio.Lock(), rescan)
+
+        asyncio.run(run())
+        return rescan.is_set()
+
+    def test_retired_devices_closed_between_cycles(self, monkeypatch):
+        retired = AddressedDevice("10.0.0.4")
+        tlg._RETIRED_DEVICES.append(retired)
+        self._run(monkeypatch, answered=True)
+        assert retired.closed
+        assert tlg._RETIRED_DEVICES == []
+
+    def test_deduplicated_polls_do_not_trigger_rescan(self, monkeypatch):
+        assert not self._run(monkeypatch, answered=True)
+
+    def test_unanswered_polls_trigger_rescan(self, monkeypatch):
+        assert self._run(monkeypatch, answered=False)
+
+
+class TestRescanForever:
+    def _run(self, monkeypatch, failures):
+        calls = []
+
+        async def fake_refresh(devices, lock, devices_info=None):
+            calls.append(1)
+
+        monkeypatch.setattr(tlg, "_refresh_devices", fake_refresh)
+        monkeypatch.setattr(tlg, "_DEVICE_FAILURES", failures)
+
+        async def run():
+            with pytest.raises(TimeoutError):
+                async with asyncio.timeout(0.05):
+                    await tlg._rescan_forever({"abc": FakeDevice({})}, asyncio.Lock(), asyncio.Event(), 0.02)
+
+        asyncio.run(run())
+        return len(calls)
+
+    def test_periodic_scan_skipped_while_healthy(self, monkeypatch):
+        assert self._run(monkeypatch, {}) == 0
+
+    def test_periodic_scan_runs_when_a_device_is_failing(self, monkeypatch):
+        assert self._run(monkeypatch, {"abc": 1}) >= 1
+
+
+class TestPollPool:
+    def test_status_runs_on_dedicated_pool(self):
+        import threading
+
+        class ThreadRecordingDevice(FakeDevice):
+            def status(self):
+                self.thread_name = threading.current_thread().name
+                return super().status()
+
+        device = ThreadRecordingDevice({"dps": {"1": True}})
+        asyncio.run(tlg.get_device_metrics(device, "abc", retries=1))
+        assert device.thread_name.startswith("tuya-poll")
+
+    def test_semaphore_capped_at_pool_size(self):
+        async def size(count):
+            return tlg._poll_semaphore(count)._value
+
+        assert asyncio.run(size(3)) == 3
+        assert asyncio.run(size(100)) == tlg._TUYA_POOL_WORKERS
+
+
+def test_local_state_age_stays_inside_cloud_ttl():
+    import tuya_cloud_to_graphite
+    worst_age = (tlg._TUYA_LOCAL_STATE_REFRESH_INTERVAL + tlg._TUYA_LOCAL_STATE_FLUSH_INTERVAL
+                 + tlg.config.SMART_PLUG_POLL_INTERVAL)
+    assert worst_age < tuya_cloud_to_graphite._LOCAL_SUCCESS_TTL_SECONDS
+
+
+class TestLocalState:
+    @pytest.fixture(autouse=True)
+    def state(self, tmp_path, monkeypatch):
+        self.path = tmp_path / "state.json"
+        self.now = 1000.0
+        self.saves = 0
+        real_save = tlg._tuya_local_save_state
+
+        def counting_save(state):
+            self.saves += 1
+            real_save(state)
+
+        monkeypatch.setattr(tlg, "_TUYA_LOCAL_STATE_FILE", str(self.path))
+        monkeypatch.setattr(tlg, "_TUYA_LOCAL_STATE", {})
+        monkeypatch.setattr(tlg, "_TUYA_LOCAL_STATE_LAST_FLUSH", 0.0)
+        monkeypatch.setattr(tlg, "_TUYA_LOCAL_STATE_DIRTY", False)
+        monkeypatch.setattr(tlg, "_TUYA_LOCAL_STATE_REFRESH_INTERVAL", 60.0)
+        monkeypatch.setattr(tlg, "_tuya_local_save_state", counting_save)
+        monkeypatch.setattr(tlg.time, "time", lambda: self.now)
+
+    def test_first_success_is_written(self):
+        _mark_local_success("abc")
+        assert self.saves == 1
+        assert tlg._tuya_local_load_state()["devices"]["abc"]["last_success_ts"] == 1000.0
+
+    def test_unchanged_bucket_skips_write(self):
+        _mark_local_success("abc")
+        self.now += 45  # past the flush interval, inside the refresh interval
+        _mark_local_success("abc")
+        assert self.saves == 1
+
+    def test_stale_entry_is_refreshed(self):
+        _mark_local_success("abc")
+        self.now += 60
+        _mark_local_success("abc")
+        assert self.saves == 2
+        assert tlg._tuya_local_load_state()["devices"]["abc"]["last_success_ts"] == 1060.0
@@ -0,0 +1,75 @@
+"""Tests for tuya_remote_scan: host list construction and SOCKS5 probing used by the tunnelled subnet scan."""
+
+import asyncio
+import subprocess
+
+import pytest
+
+import tuya_remote_scan
+
+
+async def _fake_socks_server(reply_code):
+    """Minimal SOCKS5 server answering every CONNECT with reply_code."""
+    requests = []
+
+    async def handle(reader, writer):
+        await reader.readexactly(3)
+        writer.write(b"\x05\x00")
+        request = await reader.readexactly(10)
+        requests.append(request)
+        writer.write(b"\x05" + bytes([reply_code]) + b"\x00\x01" + b"\x00" * 6)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], requests
+
+
+class TestSocks5Probe:
+    def test_open_port(self):
+        async def run():
+            server, port, requests = await _fake_socks_server(0)
+            async with server:
+                assert await tuya_remote_scan._socks5_probe(port, "192.168.1.20")
+            assert requests == [b"\x05\x01\x00\x01\xc0\xa8\x01\x14\x1a\x0c"]
+
+        asyncio.run(run())
+
+    def test_refused_port(self):
+        async def run():
+            server, port, _ = await _fake_socks_server(5)
+            async with server:
+                assert not await tuya_remote_scan._socks5_probe(port, "192.168.1.20")
+
+        asyncio.run(run())
+
+    def test_proxy_down(self):
+        port = tuya_remote_scan._free_local_port()
+        assert not asyncio.run(tuya_remote_scan._socks5_probe(port, "192.168.1.20"))
+
+
+class TestSubnetHosts:
+    def test_non_24_prefixes(self):
+        assert tuya_remote_scan._subnet_hosts("10.0.0.0/30") == ["10.0.0.1", "10.0.0.2"]
+        assert len(tuya_remote_scan._subnet_hosts("10.0.0.0/23")) == 510
+
+    def test_oversized_subnet_rejected(self):
+        with pytest.raises(ValueError):
+            tuya_remote_scan._subnet_hosts("10.0.0.0/21")
+
+
+class TestShellScan:
+    def test_host_list_sent_on_stdin(self, monkeypatch):
+        calls = []
+
+        def fake_run(cmd, input=None, **kwargs):
+            calls.append(input)
+            return subprocess.CompletedProcess(cmd, 0, stdout="10.0.0.2\n", stderr="")
+
+        monkeypatch.setattr(tuya_remote_scan.subprocess, "run", fake_run)
+        assert tuya_remote_scan.scan_remote_subnet("router", "10.0.0.0/30") == ["10.0.0.2"]
+        assert calls == ["10.0.0.1\n10.0.0.2\n"]
+
+    def test_invalid_subnet_skips_ssh(self, monkeypatch):
+        monkeypatch.setattr(tuya_remote_scan.subprocess, "run", lambda *a, **k: pytest.fail("ssh run"))
+        assert tuya_remote_scan.scan_remote_subnet("router", "not-a-subnet") == []
@@ -16,16 +16,18 @@ import argparse
 import json
 import os
 import datetime
+import itertools
 import threading
 from typing import Dict, List, Tuple, Any, Optional
 import urllib.parse
-import urllib.request
 
+import aiohttp
 import tinytuya
 
 import config
-from graphite_helper import send_metrics, format_device_name
+from graphite_helper import get_carbon_client, format_device_name, log_loop_error
 from metric_scaling import get_scaler
+from json_helper import json_loads
 
 # Logging
 logging.basicConfig(
@@ -38,7 +40,15 @@ logger = logging.getLogger(__name__)
 _metric_scaler = get_scaler()
 
 
-def _pick(d: Dict[str, Any], keys: List[str]) -> tuple:
+# Metric suffix -> candidate status codes, in order of preference.
+_METRIC_EXTRACTORS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("power_watts", ("cur_power", "power", "power_w", "add_ele")),
+    ("voltage_volts", ("cur_voltage", "voltage", "va_voltage")),
+    ("current_amps", ("cur_current", "electric_current", "i_current")),
+)
+
+
+def _pick(d: Dict[str, Any], keys: Tuple[str, ...]) -> tuple:
     """Return (key, value) for the first matching key, or (None, None)."""
     for k in keys:
         if k in d and d[k] is not None:
@@ -74,15 +84,38 @@ TUYA_CLOUD_MAX_BURST = max(5.0, TUYA_CLOUD_CALLS_PER_SECOND * 3600.0 * 6.0)
 
 
 
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
 # Quota state is persisted on disk so restarts do not reset counters
-_TUYA_CLOUD_QUOTA_STATE_FILE = os.path.join(os.path.dirname(__file__), 'tuya_cloud_quota_state.json')
+_TUYA_CLOUD_QUOTA_STATE_FILE = os.path.join(_SCRIPT_DIR, 'tuya_cloud_quota_state.json')
 _TUYA_CLOUD_QUOTA_LOCK = threading.Lock()
+# Serialises writes of the state file only; never held with the quota lock.
+_TUYA_CLOUD_QUOTA_SAVE_LOCK = threading.Lock()
+
+
+def _tuya_cloud_next_month_epoch(now: datetime.datetime) -> float:
+    """Return the epoch of 00:00 UTC on the first day of the month after now."""
+    if now.month == 12:
+        year, month = now.year + 1, 1
+    else:
+        year, month = now.year, now.month + 1
+    return datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+
+# (valid_until_epoch, key) – the month key only changes at the rollover
+# epoch, so avoid rebuilding it on every quota check.
+_MONTH_KEY_CACHE: Tuple[float, str] = (0.0, "")
 
 
 def _tuya_cloud_current_month_key() -> str:
     """Return the current calendar month key as YYYY-MM in UTC."""
-    now = datetime.datetime.utcnow()
-    return f"{now.year:04d}-{now.month:02d}"
+    global _MONTH_KEY_CACHE
+    if time.time() < _MONTH_KEY_CACHE[0]:
+        return _MONTH_KEY_CACHE[1]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    key = now.strftime('%Y-%m')
+    _MONTH_KEY_CACHE = (_tuya_cloud_next_month_epoch(now), key)
+    return key
 
 
 def _tuya_cloud_load_quota_state() -> dict:
@@ -128,34 +161,93 @@ def _refill_tokens() -> float:
     return _TUYA_CLOUD_TOKENS
 
 
+# Persisted monthly call counter; loaded from disk on first use.
+_TUYA_CLOUD_QUOTA_STATE: Optional[dict] = None
+# Like the local poller's state file, the counter is written at most every
+# 30 s (and only when it changed) to spare the Pi's storage; a restart can
+# lose at most that window of counted calls.
+_TUYA_CLOUD_QUOTA_FLUSH_INTERVAL: float = 30.0  # seconds
+_TUYA_CLOUD_QUOTA_LAST_FLUSH: float = 0.0
+_TUYA_CLOUD_QUOTA_DIRTY: bool = False
+# Epoch at which the monthly counter must next be checked for a month
+# change; 0.0 forces a check on first use.
+_MONTH_ROLLOVER_EPOCH: float = 0.0
+
+
 def _tuya_cloud_can_spend(api_calls: int) -> bool:
     """Return True if we are allowed to make additional cloud API calls.
 
     Enforces a rolling rate limit using a token bucket so the average rate
-    never exceeds TUYA_CLOUD_CALLS_PER_SECOND when the process runs continuously.
+    never exceeds TUYA_CLOUD_CALLS_PER_SECOND when the process runs continuously,
+    plus the persisted monthly cap so restarts cannot overspend.
+
+    Only in-memory counters are touched while holding _TUYA_CLOUD_QUOTA_LOCK;
+    when a (throttled) flush is due the quota state is copied and written to
+    disk after the lock is released.
     """
     if api_calls <= 0:
         return True
 
-    global _TUYA_CLOUD_TOKENS
-    tokens = _refill_tokens()
+    global _TUYA_CLOUD_TOKENS, _TUYA_CLOUD_QUOTA_STATE, _MONTH_ROLLOVER_EPOCH
+    global _TUYA_CLOUD_QUOTA_LAST_FLUSH, _TUYA_CLOUD_QUOTA_DIRTY
+    if _TUYA_CLOUD_QUOTA_STATE is None:
+        loaded = _tuya_cloud_load_quota_state()
+        with _TUYA_CLOUD_QUOTA_LOCK:
+            if _TUYA_CLOUD_QUOTA_STATE is None:
+                _TUYA_CLOUD_QUOTA_STATE = loaded
+                _MONTH_ROLLOVER_EPOCH = 0.0
+
     required = float(api_calls)
-    if tokens >= required:
-        _TUYA_CLOUD_TOKENS -= required
+    allowed = False
+    state_copy = None
+    with _TUYA_CLOUD_QUOTA_LOCK:
+        state = _TUYA_CLOUD_QUOTA_STATE
+        if time.time() >= _MONTH_ROLLOVER_EPOCH:
+            month = _tuya_cloud_current_month_key()
+            if state.get('month') != month:
+                state['month'] = month
+                state['api_calls'] = 0
+                _TUYA_CLOUD_QUOTA_DIRTY = True
+            _MONTH_ROLLOVER_EPOCH = _MONTH_KEY_CACHE[0]
+        tokens = _refill_tokens()
+        month_calls = state['api_calls']
+        quota_month = state['month']
+        within_month = month_calls + api_calls <= TUYA_CLOUD_API_CALLS_PER_MONTH
+        if within_month and tokens >= required:
+            _TUYA_CLOUD_TOKENS -= required
+            state['api_calls'] = month_calls + api_calls
+            _TUYA_CLOUD_QUOTA_DIRTY = True
+            allowed = True
+        now = time.time()
+        if _TUYA_CLOUD_QUOTA_DIRTY and now - _TUYA_CLOUD_QUOTA_LAST_FLUSH >= _TUYA_CLOUD_QUOTA_FLUSH_INTERVAL:
+            state_copy = dict(state)
+            _TUYA_CLOUD_QUOTA_LAST_FLUSH = now
+            _TUYA_CLOUD_QUOTA_DIRTY = False
+
+    if state_copy is not None:
+        with _TUYA_CLOUD_QUOTA_SAVE_LOCK:
+            _tuya_cloud_save_quota_state(state_copy)
+    if allowed:
         return True
 
-    logger.info(
-        "Tuya cloud rate limit reached: need %.2f tokens, have %.2f; "
-        "skipping API call",
-        required,
-        tokens,
-    )
+    if not within_month:
+        logger.info(
+            "Tuya cloud monthly cap reached (%d/%d calls in %s); skipping API call",
+            month_calls,
+            TUYA_CLOUD_API_CALLS_PER_MONTH,
+            quota_month,
+        )
+    else:
+        logger.info(
+            "Tuya cloud rate limit reached: need %.2f tokens, have %.2f; "
+            "skipping API call",
+            required,
+            tokens,
+        )
     return False
 
 
-
-
-_TUYA_LOCAL_STATE_FILE = os.path.join(os.path.dirname(__file__), 'tuya_local_state.json')
+_TUYA_LOCAL_STATE_FILE = os.path.join(_SCRIPT_DIR, 'tuya_local_state.json')
 # Consider a device "covered" by local polling if we saw a success recently.
 _LOCAL_SUCCESS_TTL_SECONDS = 10 * getattr(config, 'SMART_PLUG_POLL_INTERVAL', 30)
 # When checking Graphite for cross-host local coverage we can use a
@@ -169,7 +261,8 @@ _LOCAL_GRAPHITE_TTL_SECONDS = getattr(
 
 def _tuya_cloud_available_tokens() -> float:
     """Return current token bucket balance after refilling (read-only; does not consume tokens)."""
-    return _refill_tokens()
+    with _TUYA_CLOUD_QUOTA_LOCK:
+        return _refill_tokens()
 
 
 def _load_recent_local_successes(now: Optional[float] = None) -> dict[str, float]:
@@ -182,11 +275,9 @@ def _load_recent_local_successes(now: Optional[float] = None) -> dict[str, float
     if now is None:
         now = time.time()
     try:
-        if not os.path.exists(_TUYA_LOCAL_STATE_FILE):
-            return {}
         with open(_TUYA_LOCAL_STATE_FILE, 'r') as f:
             data = json.load(f)
-    except Exception:
+    except Exception:  # missing, unreadable or corrupt – no local hints
         return {}
 
     if not isinstance(data, dict) or data.get('version') not in (1,):
@@ -206,7 +297,31 @@ def _load_recent_local_successes(now: Optional[float] = None) -> dict[str, float
     return devices
 
 
-def _graphite_has_recent_local_metrics(dev: dict[str, Any], now: Optional[float] = None) -> bool:
+# Shared keep-alive HTTP session for Graphite render queries. Created lazily
+# because aiohttp sessions must be constructed inside the running event loop.
+_HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+def _http_session() -> aiohttp.ClientSession:
+    """Return the shared Graphite HTTP session, creating it on first use."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None or _HTTP_SESSION.closed:
+        _HTTP_SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=3),
+        )
+    return _HTTP_SESSION
+
+
+async def _close_http_session() -> None:
+    """Close the shared Graphite HTTP session if one was opened."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None and not _HTTP_SESSION.closed:
+        await _HTTP_SESSION.close()
+    _HTTP_SESSION = None
+
+
+async def _graphite_has_recent_local_metrics(dev: dict[str, Any], now: Optional[float] = None) -> bool:
     """Return True if Graphite has recent local Tuya metrics for this device.
 
     This lets a Tuya Cloud poller running on one host honour local‑LAN
@@ -236,9 +351,10 @@ def _graphite_has_recent_local_metrics(dev: dict[str, Any], now: Optional[float]
     url = f"http://{config.CARBON_SERVER}/render?{params}"
 
     try:
-        with urllib.request.urlopen(url, timeout=3) as resp:
-            payload = resp.read()
-        data = json.loads(payload.decode('utf-8'))
+        async with _http_session().get(url) as resp:
+            resp.raise_for_status()
+            payload = await resp.read()
+        data = json_loads(payload)
     except Exception as e:  # Graphite down or HTTP error – fall back to file-based hints only.
         logger.debug(f"Graphite local-coverage check failed for {target}: {e}")
         return False
@@ -249,14 +365,17 @@ def _graphite_has_recent_local_metrics(dev: dict[str, Any], now: Optional[float]
     for series in data:
         if not isinstance(series, dict):
             continue
-        points = series.get('datapoints') or []
-        for value, ts in points:
+        # maxDataPoints=1 consolidates the window into one point; only the
+        # last point needs checking.
+        points = series.get('datapoints')
+        if points:
+            value, ts = points[-1]
             if value is not None and isinstance(ts, (int, float)) and ts >= now - _LOCAL_GRAPHITE_TTL_SECONDS:
                 return True
     return False
 
 
-def _filter_devices_needing_cloud(devices: list[dict[str, Any]]) -> list[dict[str, Any]]:
+async def _filter_devices_needing_cloud(devices: list[dict[str, Any]]) -> list[dict[str, Any]]:
     """Return only devices that are not recently covered by local polling.
 
     A device is considered "covered" if either:
@@ -271,28 +390,25 @@ def _filter_devices_needing_cloud(devices: list[dict[str, Any]]) -> list[dict[st
     now = time.time()
     recent_local = _load_recent_local_successes(now)
 
+    # 1) Same-host hint from tuya_local_state.json. In the steady state this
+    # covers every device, so no Graphite round-trips are needed at all.
+    remaining: list[dict[str, Any]] = [
+        dev for dev in devices
+        if not isinstance(dev, dict)
+        or str(dev.get('id') or dev.get('uuid') or '') not in recent_local
+    ]
+    skipped = len(devices) - len(remaining)
+
+    # 2) Cross-host hint via Graphite metrics, only for the uncovered remainder.
+    # Probes run concurrently over the shared keep-alive session.
+    covered = await asyncio.gather(
+        *(_graphite_has_recent_local_metrics(dev, now) for dev in remaining)
+    )
     filtered: list[dict[str, Any]] = []
-    skipped = 0
-    for dev in devices:
-        if not isinstance(dev, dict):
-            filtered.append(dev)
-            continue
-
-        dev_id = dev.get('id') or dev.get('uuid')
-        locally_ok = False
-
-        # 1) Same-host hint from tuya_local_state.json
-        if dev_id and str(dev_id) in recent_local:
-            locally_ok = True
-        else:
-            # 2) Cross-host hint via Graphite metrics
-            if _graphite_has_recent_local_metrics(dev, now):
-                locally_ok = True
-
+    for dev, locally_ok in zip(remaining, covered):
         if locally_ok:
             skipped += 1
             continue
-
         filtered.append(dev)
 
     if skipped:
@@ -304,6 +420,42 @@ def _filter_devices_needing_cloud(devices: list[dict[str, Any]]) -> list[dict[st
     return filtered
 
 
+# Tuya product categories that can report power: sockets (cz), power strips
+# (pc), switches (kg) and circuit breakers (dlq). Other devices (gateways,
+# water timers, alarms, ...) would only burn cloud API quota.
+TUYA_CLOUD_METERING_CATEGORIES = frozenset(
+    getattr(config, 'TUYA_CLOUD_METERING_CATEGORIES', ('cz', 'pc', 'kg', 'dlq'))
+)
+
+
+def _filter_pollable_devices(devices: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Drop devices that are offline or cannot report power metrics.
+
+    Applied whenever the device list is (re)fetched, so the exclusions
+    persist between polls until the next scheduled refresh.
+    """
+    pollable: list[dict[str, Any]] = []
+    offline = unsupported = 0
+    for dev in devices:
+        if isinstance(dev, dict):
+            category = dev.get('category')
+            if category and category not in TUYA_CLOUD_METERING_CATEGORIES:
+                unsupported += 1
+                continue
+            if dev.get('online') is False:
+                offline += 1
+                continue
+        pollable.append(dev)
+
+    if offline or unsupported:
+        logger.info(
+            'Excluding %d offline and %d non-metering Tuya devices from cloud polling',
+            offline,
+            unsupported,
+        )
+    return pollable
+
+
 async def _cloud():
 
     # tinytuya.Cloud() reads tinytuya.json by default
@@ -327,9 +479,9 @@ async def cloud_list_devices(cloud, enforce_quota: bool = True) -> List[Dict[str
             # Handle string response (error or JSON)
             if isinstance(result, str):
                 try:
-                    result = json.loads(result)
+                    result = json_loads(result)
                 except json.JSONDecodeError:
-                    logger.error(f"Device list is non-JSON string: {repr(result)[:200]}")
+                    logger.error("Device list is non-JSON string: %.200r", result)
                     return []
             
             # Handle dict response (might have 'result' field with device list)
@@ -364,15 +516,16 @@ async def cloud_list_devices(cloud, enforce_quota: bool = True) -> List[Dict[str
                 elif isinstance(item, str):
                     # Try to parse as JSON
                     try:
-                        parsed = json.loads(item)
+                        parsed = json_loads(item)
                         if isinstance(parsed, dict):
                             devices.append(parsed)
                         else:
-                            logger.warning(f"Device item parsed but not a dict: {type(parsed)}")
+                            logger.warning("Device item parsed but not a dict: %s", type(parsed))
                     except json.JSONDecodeError:
-                        logger.warning(f"Device item is unparseable string: {repr(item)[:100]}")
+                        if logger.isEnabledFor(logging.WARNING):
+                            logger.warning("Device item is unparseable string: %s", repr(item)[:100])
                 else:
-                    logger.warning(f"Device item unexpected type: {type(item)}")
+                    logger.warning("Device item unexpected type: %s", type(item))
             
             return devices
             
@@ -413,6 +566,18 @@ def normalize_tuya_response(resp: Any, device_id: str) -> Dict[str, Any]:
     """
     if not resp:
         return {}
+
+    # Fast path: the usual tinytuya shape {'success': True, 'result': [{code, value}, ...]}
+    if type(resp) is dict and resp.get('success', True):
+        result = resp.get('result')
+        if type(result) is list:
+            status: Dict[str, Any] = {}
+            for item in result:
+                if type(item) is dict and 'code' in item:
+                    status[item['code']] = item.get('value')
+                else:
+                    logger.debug(f"{device_id}: Unexpected list item type: {type(item)}")
+            return status
     
     # Handle stringified JSON responses
     if isinstance(resp, str):
@@ -445,7 +610,7 @@ def normalize_tuya_response(resp: Any, device_id: str) -> Dict[str, Any]:
             return {}
     
     # Parse result based on type
-    status: Dict[str, Any] = {}
+    status = {}
     
     if isinstance(result, list):
         # List of {'code': ..., 'value': ...} dicts
@@ -507,30 +672,17 @@ async def get_device_metrics(cloud, dev: Any) -> List[Tuple[str, float]]:
         base = f"{config.METRIC_PREFIX}.tuya.{device_name}"
 
         # On/off state
-        _, is_on = _pick(status, ['switch', 'switch_1', 'switch_0', 'power_switch'])
+        _, is_on = _pick(status, ('switch', 'switch_1', 'switch_0', 'power_switch'))
         if isinstance(is_on, bool):
             metrics.append((f"{base}.is_on", 1 if is_on else 0))
 
-        # Power (watts)
-        metric_code, p = _pick(status, ['cur_power', 'power', 'power_w', 'add_ele'])
-        if metric_code is not None:
-            pw = _metric_scaler.normalize_by_code(devid, metric_code, p, product_id=product_id)
-            if pw is not None:
-                metrics.append((f"{base}.power_watts", pw))
-
-        # Voltage (volts)
-        metric_code, v = _pick(status, ['cur_voltage', 'voltage', 'va_voltage'])
-        if metric_code is not None:
-            vv = _metric_scaler.normalize_by_code(devid, metric_code, v, product_id=product_id)
-            if vv is not None:
-                metrics.append((f"{base}.voltage_volts", vv))
-
-        # Current (amps)
-        metric_code, a = _pick(status, ['cur_current', 'electric_current', 'i_current'])
-        if metric_code is not None:
-            aa = _metric_scaler.normalize_by_code(devid, metric_code, a, product_id=product_id)
-            if aa is not None:
-                metrics.append((f"{base}.current_amps", aa))
+        # Power (watts), voltage (volts), current (amps)
+        for suffix, keys in _METRIC_EXTRACTORS:
+            metric_code, raw = _pick(status, keys)
+            if metric_code is not None:
+                value = _metric_scaler.normalize_by_code(devid, metric_code, raw, product_id=product_id)
+                if value is not None:
+                    metrics.append((f"{base}.{suffix}", value))
 
         logger.debug(f"Collected {len(metrics)} metrics from {name} ({devid})")
         
@@ -541,20 +693,25 @@ async def get_device_metrics(cloud, dev: Any) -> List[Tuple[str, float]]:
 
 
 async def poll_devices_once(cloud, devices: List[Dict[str, Any]]) -> int:
-    all_metrics: List[Tuple[str, float]] = []
+    # One timestamp for the whole cycle so Graphite sees a coherent snapshot
+    timestamp = int(time.time())
     tasks = [get_device_metrics(cloud, d) for d in devices]
     results = await asyncio.gather(*tasks, return_exceptions=True)
+    all_metrics: List[Tuple[str, float]] = list(
+        itertools.chain.from_iterable(res for res in results if isinstance(res, list))
+    )
     for res in results:
-        if isinstance(res, list):
-            all_metrics.extend(res)
-        else:
+        if not isinstance(res, list):
             logger.error(f"Device polling error: {res}")
 
     if not all_metrics:
         logger.warning("No Tuya cloud metrics collected")
         return 0
 
-    count = send_metrics(config.CARBON_SERVER, config.CARBON_PORT, all_metrics)
+    client = get_carbon_client(
+        config.CARBON_SERVER, config.CARBON_PORT, getattr(config, 'CARBON_PICKLE_PORT', None)
+    )
+    count = await client.send(all_metrics, timestamp)
     logger.info(f"Sent {count} Tuya cloud metrics to Graphite")
     return count
 
@@ -587,9 +744,9 @@ async def discover_and_print():
 async def poll_once():
     
     cloud = await _cloud()
-    devices = await cloud_list_devices(cloud)
+    devices = _filter_pollable_devices(await cloud_list_devices(cloud))
     if not devices:
-        print("No Tuya devices found in cloud project.")
+        print("No pollable Tuya devices found in cloud project.")
         return
     print("\nPolling Tuya cloud devices...")
     count = await poll_devices_once(cloud, devices)
@@ -612,7 +769,7 @@ async def main_loop():
     )
 
     cloud = await _cloud()
-    devices = await cloud_list_devices(cloud)
+    devices = _filter_pollable_devices(await cloud_list_devices(cloud))
     
     if not devices:
         logger.warning("No Tuya devices found in cloud project initially. Will retry...")
@@ -626,7 +783,7 @@ async def main_loop():
                 # Poll devices if we have any, but avoid wasting cloud calls
                 # on devices that are healthy via local LAN polling.
                 if devices:
-                    devices_to_poll = _filter_devices_needing_cloud(devices)
+                    devices_to_poll = await _filter_devices_needing_cloud(devices)
                     if not devices_to_poll:
                         logger.info("All Tuya devices recently reachable via local polling; skipping cloud poll")
                     else:
@@ -647,7 +804,9 @@ async def main_loop():
                 if time.time() - last_discovery >= discovery_interval:
                     try:
                         logger.info("Refreshing Tuya cloud device list (scheduled 6h refresh)...")
-                        new_devices = await cloud_list_devices(cloud, enforce_quota=False)
+                        new_devices = _filter_pollable_devices(
+                            await cloud_list_devices(cloud, enforce_quota=False)
+                        )
                         if new_devices:
                             devices = new_devices
                             logger.info(f"Refreshed device list: {len(devices)} devices")
@@ -656,12 +815,14 @@ async def main_loop():
                         logger.error(f"Error refreshing cloud device list: {e}")
                 
             except Exception as e:
-                logger.error(f"Error in main loop iteration: {e}", exc_info=True)
+                log_loop_error(logger, "Error in main loop iteration", e)
             
             await asyncio.sleep(config.SMART_PLUG_POLL_INTERVAL)
             
     except KeyboardInterrupt:
         logger.info("Shutting down...")
+    finally:
+        await _close_http_session()
 
 
 def main():
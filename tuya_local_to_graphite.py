@@ -15,15 +15,25 @@ import logging
 import argparse
 import json
 import os
-from typing import Dict, List, Tuple, Any, Optional
+import random
+import socket
+import importlib
+import types
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Dict, List, Tuple, Any, Optional
 
 import tinytuya
 
 import config
-from graphite_helper import send_metrics, format_device_name
+from graphite_helper import (
+    CarbonSendQueue, MetricDeduper, get_carbon_client, format_device_name, log_loop_error,
+)
 from device_names import get_device_name
-from tuya_remote_scan import scan_remote_subnet
-from metric_scaling import get_scaler
+from json_helper import json_dumps, json_loads, json_loads_lenient, orjson
+from tuya_remote_scan import scan_remote_subnet_async
+from metric_scaling import DEVICES_JSON_PATH, get_scaler
 
 # Logging
 logging.basicConfig(
@@ -36,10 +46,54 @@ logger = logging.getLogger(__name__)
 _metric_scaler = get_scaler()
 
 
-_TUYA_LOCAL_STATE_FILE = os.path.join(os.path.dirname(__file__), 'tuya_local_state.json')
+def _install_fast_json() -> None:
+    """Have tinytuya decode device replies with orjson when it is installed.
+
+    Only the `json` global of tinytuya's device module is swapped (for a
+    namespace whose loads() is orjson-backed), so json use elsewhere in
+    the process is untouched.
+    """
+    if orjson is None:
+        return
+    # Newer tinytuya splits core into a package; older releases keep it in core.py
+    for module_name in ('tinytuya.core.XenonDevice', 'tinytuya.core'):
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        if getattr(module, 'json', None) is json:
+            module.json = types.SimpleNamespace(
+                loads=json_loads_lenient, load=json.load, dumps=json.dumps, dump=json.dump
+            )
+            return
+
+
+_install_fast_json()
+
+# Unchanged readings are only re-sent every METRIC_KEEPALIVE_POLLS polls.
+# power_watts is exempt: the cloud poller's coverage check and
+# aggregate_energy.py both treat a recent power point as "device alive".
+_deduper = MetricDeduper()
+_ALWAYS_SENT_SUFFIX = '.power_watts'
+
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_TUYA_LOCAL_STATE_FILE = os.path.join(_SCRIPT_DIR, 'tuya_local_state.json')
 _TUYA_LOCAL_STATE: dict = {}
 _TUYA_LOCAL_STATE_LAST_FLUSH: float = 0.0
 _TUYA_LOCAL_STATE_FLUSH_INTERVAL: float = 30.0  # seconds
+# A device's last_success_ts is only advanced once it is this old, and the
+# file is only rewritten when something advanced. The worst-case age of a
+# timestamp on disk is refresh + flush + one poll interval, which must stay
+# inside tuya_cloud_to_graphite's _LOCAL_SUCCESS_TTL_SECONDS (10 polls) or
+# the cloud poller spends quota on healthy LAN devices. Use half of what is
+# left of that TTL as margin, capped at 60 s (30 s at a 10 s poll interval).
+_TUYA_LOCAL_STATE_REFRESH_INTERVAL: float = max(0.0, min(60.0, (
+    10 * config.SMART_PLUG_POLL_INTERVAL
+    - _TUYA_LOCAL_STATE_FLUSH_INTERVAL
+    - config.SMART_PLUG_POLL_INTERVAL
+) / 2))
+_TUYA_LOCAL_STATE_DIRTY: bool = False
 
 
 def _tuya_local_load_state() -> dict:
@@ -47,8 +101,8 @@ def _tuya_local_load_state() -> dict:
     try:
         if not os.path.exists(_TUYA_LOCAL_STATE_FILE):
             return {'version': 1, 'devices': {}}
-        with open(_TUYA_LOCAL_STATE_FILE, 'r') as f:
-            data = json.load(f)
+        with open(_TUYA_LOCAL_STATE_FILE, 'rb') as f:
+            data = json_loads(f.read())
         if not isinstance(data, dict):
             return {'version': 1, 'devices': {}}
         data.setdefault('version', 1)
@@ -68,8 +122,8 @@ def _tuya_local_save_state(state: dict) -> None:
     state['updated_at_ts'] = time.time()
     try:
         tmp_path = _TUYA_LOCAL_STATE_FILE + '.tmp'
-        with open(tmp_path, 'w') as f:
-            json.dump(state, f)
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps(state))
         os.replace(tmp_path, _TUYA_LOCAL_STATE_FILE)
     except Exception:
         # Best-effort only; failures here should not break polling.
@@ -82,19 +136,70 @@ def _mark_local_success(device_id: str) -> None:
     This state is consumed by tuya_cloud_to_graphite.py so we avoid
     wasting Tuya Cloud tokens on devices that are healthy via LAN.
     """
-    global _TUYA_LOCAL_STATE, _TUYA_LOCAL_STATE_LAST_FLUSH
+    global _TUYA_LOCAL_STATE, _TUYA_LOCAL_STATE_LAST_FLUSH, _TUYA_LOCAL_STATE_DIRTY
     now = time.time()
     if not _TUYA_LOCAL_STATE:
         _TUYA_LOCAL_STATE = _tuya_local_load_state()
     devices = _TUYA_LOCAL_STATE.setdefault('devices', {})
     if not isinstance(devices, dict):
         devices = _TUYA_LOCAL_STATE['devices'] = {}
-    devices[device_id] = {'last_success_ts': now}
+    entry = devices.get(device_id)
+    last_ts = entry.get('last_success_ts') if isinstance(entry, dict) else None
+    if not isinstance(last_ts, (int, float)) or now - last_ts >= _TUYA_LOCAL_STATE_REFRESH_INTERVAL:
+        devices[device_id] = {'last_success_ts': now}
+        _TUYA_LOCAL_STATE_DIRTY = True
 
     # Throttle disk writes to avoid excessive wear on the Pi's storage.
-    if now - _TUYA_LOCAL_STATE_LAST_FLUSH >= _TUYA_LOCAL_STATE_FLUSH_INTERVAL:
+    if _TUYA_LOCAL_STATE_DIRTY and now - _TUYA_LOCAL_STATE_LAST_FLUSH >= _TUYA_LOCAL_STATE_FLUSH_INTERVAL:
         _tuya_local_save_state(_TUYA_LOCAL_STATE)
         _TUYA_LOCAL_STATE_LAST_FLUSH = now
+        _TUYA_LOCAL_STATE_DIRTY = False
+
+
+# Last successful scan result, so a restart can start polling immediately
+# instead of waiting for a full deviceScan.
+_TUYA_DEVICE_CACHE_FILE = os.path.join(_SCRIPT_DIR, 'tuya_local_devices.json')
+# Drop a device from the cache after this many consecutive failed polls
+# (its IP has probably changed).
+_DEVICE_CACHE_MAX_FAILURES = 5
+_DEVICE_FAILURES: Dict[str, int] = {}
+
+
+def _load_device_cache() -> Dict[str, Dict[str, Any]]:
+    """Best-effort load of the last scan result from disk."""
+    try:
+        with open(_TUYA_DEVICE_CACHE_FILE, 'rb') as f:
+            data = json_loads(f.read())
+    except Exception:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {dev_id: info for dev_id, info in data.items()
+            if isinstance(info, dict) and info.get('ip')}
+
+
+def _save_device_cache(devices_info: Dict[str, Dict[str, Any]]) -> None:
+    """Persist a scan result atomically; failures are logged and ignored."""
+    try:
+        tmp_path = _TUYA_DEVICE_CACHE_FILE + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps(devices_info))
+        os.replace(tmp_path, _TUYA_DEVICE_CACHE_FILE)
+    except Exception as e:
+        logger.warning(f"Failed to save Tuya device cache: {e}")
+
+
+def _record_poll_result(device_id: str, ok: bool) -> None:
+    """Track consecutive failures and evict persistently failing devices from the cache."""
+    if ok:
+        _DEVICE_FAILURES.pop(device_id, None)
+        return
+    failures = _DEVICE_FAILURES[device_id] = _DEVICE_FAILURES.get(device_id, 0) + 1
+    if failures == _DEVICE_CACHE_MAX_FAILURES:
+        cached = _load_device_cache()
+        if cached.pop(device_id, None) is not None:
+            logger.info(f"{device_id} failed {failures} polls in a row; removing from device cache")
+            _save_device_cache(cached)
 
 
 async def scan_for_devices() -> Dict[str, Dict[str, Any]]:
@@ -156,8 +261,8 @@ async def scan_for_devices() -> Dict[str, Dict[str, Any]]:
             password_env_var = getattr(config, 'SSH_PASSWORD_ENV_VAR', 'OPENWRT_PASSWORD')
             
             logger.info(f"Scanning remote subnet {remote_subnet} via {ssh_host}...")
-            remote_ips = await asyncio.to_thread(
-                scan_remote_subnet, ssh_host, remote_subnet, ssh_identity, use_sshpass, password_env_var
+            remote_ips = await scan_remote_subnet_async(
+                ssh_host, remote_subnet, ssh_identity, use_sshpass, password_env_var
             )
             
             # Remote devices found - would need proper device info to add them
@@ -168,10 +273,118 @@ async def scan_for_devices() -> Dict[str, Dict[str, Any]]:
             logger.warning(f"Remote subnet scan failed: {e}")
     
     logger.info(f"Discovered {len(devices)} Tuya device(s)")
+    if devices:
+        _save_device_cache(devices)
     return devices
 
 
-async def get_device_metrics(device: tinytuya.Device, device_id: str, retries: int = 3) -> List[Tuple[str, float]]:
+# Common DPS mappings (may vary by device): candidate DPS IDs -> metric
+# suffix. The first candidate present in a status reply is used.
+#   1: switch (on/off)
+#   19/4/6: power (W * 10)
+#   20: voltage (V * 10)
+#   18: current (mA)
+_DPS_METRICS: Tuple[Tuple[Tuple[str, ...], str], ...] = (
+    (('1',), 'is_on'),
+    (('19', '4', '6'), 'power_watts'),
+    (('20',), 'voltage_volts'),
+    (('18',), 'current_amps'),
+)
+
+
+def _is_on(dps_id: str, raw: Any) -> int:
+    return 1 if raw else 0
+
+
+@dataclass(frozen=True)
+class DeviceMetricPlan:
+    """Precomputed metric names and normalisers for one device.
+
+    Each entry is (candidate DPS IDs, full metric name, normaliser), where
+    the normaliser takes (dps_id, raw_value) and returns a value or None.
+    """
+    base: str
+    entries: Tuple[Tuple[Tuple[str, ...], str, Callable[[str, Any], Optional[float]]], ...]
+
+
+# device_id -> plan; rebuilt by _build_devices on every (re)scan so renamed
+# devices pick up their new metric path. Only replaced wholesale, on the
+# event loop, via _install_metric_plans.
+_METRIC_PLANS: Dict[str, DeviceMetricPlan] = {}
+
+
+def _build_metric_plan(device_id: str) -> DeviceMetricPlan:
+    """Resolve the metric path and normalisers for a device."""
+    # Use device ID as stable identifier, get friendly name from persistence
+    base = f"{config.METRIC_PREFIX}.tuya.{format_device_name(get_device_name(device_id))}"
+    scaled = partial(_metric_scaler.normalize_by_dps, device_id)
+    entries = tuple(
+        (dps_ids, f"{base}.{suffix}", _is_on if suffix == 'is_on' else scaled)
+        for dps_ids, suffix in _DPS_METRICS
+    )
+    return DeviceMetricPlan(base=base, entries=entries)
+
+
+def _install_metric_plans(plans: Dict[str, DeviceMetricPlan]) -> None:
+    """Swap in plans built by _build_devices; call from the event loop."""
+    global _METRIC_PLANS
+    _METRIC_PLANS = plans
+
+
+def _metric_plan(device_id: str) -> DeviceMetricPlan:
+    """Return the cached plan for a device, building it on first use."""
+    plan = _METRIC_PLANS.get(device_id)
+    if plan is None:
+        plan = _METRIC_PLANS[device_id] = _build_metric_plan(device_id)
+    return plan
+
+
+# device.status() calls run on a dedicated, bounded pool rather than the
+# default executor, so a large fleet cannot crowd out other to_thread work
+# (scans, device builds, Carbon I/O) or spawn dozens of threads on a Pi.
+_TUYA_POOL_WORKERS: int = getattr(config, 'TUYA_POLL_WORKERS', 8)
+_TUYA_POOL: Optional[ThreadPoolExecutor] = None
+
+# Bounds concurrent status() calls to the pool size so polls never queue
+# behind each other inside the executor while their timeout runs.
+_POLL_SEM: Optional[asyncio.Semaphore] = None
+_POLL_SEM_SIZE: int = 0
+
+
+def _tuya_pool() -> ThreadPoolExecutor:
+    """Return the status() thread pool, creating it on first use."""
+    global _TUYA_POOL
+    if _TUYA_POOL is None:
+        _TUYA_POOL = ThreadPoolExecutor(max_workers=_TUYA_POOL_WORKERS, thread_name_prefix='tuya-poll')
+    return _TUYA_POOL
+
+
+def _poll_semaphore(device_count: Optional[int] = None) -> asyncio.Semaphore:
+    """Return the poll semaphore, resizing it when the device count changes."""
+    global _POLL_SEM, _POLL_SEM_SIZE
+    if device_count is not None:
+        size = max(1, min(_TUYA_POOL_WORKERS, device_count))
+    else:
+        size = _POLL_SEM_SIZE or _TUYA_POOL_WORKERS
+    if _POLL_SEM is None or size != _POLL_SEM_SIZE:
+        _POLL_SEM = asyncio.Semaphore(size)
+        _POLL_SEM_SIZE = size
+    return _POLL_SEM
+
+
+async def _backoff(attempt: int, base: float = 2.0, cap: float = 10.0) -> None:
+    """Sleep for a jittered exponential back-off before retry number attempt.
+
+    The delay is drawn from [50%, 100%] of min(cap, base * 2**(attempt-1)),
+    so devices that failed together (e.g. an AP reboot) don't retry in
+    lockstep.
+    """
+    delay = min(cap, base * (2 ** (attempt - 1)))
+    await asyncio.sleep(delay * (0.5 + random.random() * 0.5))
+
+
+async def get_device_metrics(device: tinytuya.Device, device_id: str, retries: int = 3,
+                             plan: Optional[DeviceMetricPlan] = None) -> List[Tuple[str, float]]:
     """
     Get power metrics from a Tuya device with retry logic
     
@@ -179,16 +392,25 @@ async def get_device_metrics(device: tinytuya.Device, device_id: str, retries: i
         device: Tuya Device object
         device_id: Device ID for logging
         retries: Number of retry attempts
+        plan: Precomputed metric plan (looked up from the cache if omitted)
         
     Returns:
         List of (metric_name, value) tuples
     """
     for attempt in range(1, retries + 1):
         try:
-            status = await asyncio.wait_for(
-                asyncio.to_thread(device.status),
-                timeout=5
-            )
+            # Hold a slot only for the blocking call; retry sleeps happen outside.
+            # No asyncio-level timeout: cancelling the await would not stop the
+            # worker thread, so the slot would be freed while the pool is still
+            # busy. The device's own socket timeout (see _build_device) bounds
+            # the call.
+            async with _poll_semaphore():
+                status = await asyncio.get_running_loop().run_in_executor(_tuya_pool(), device.status)
+            
+            # tinytuya swallows socket errors and timeouts and hands back an
+            # error dict ({'Error': ..., 'Err': '901', 'Payload': None}).
+            if isinstance(status, dict) and 'Err' in status:
+                raise ConnectionError(f"{status.get('Error')} (Err {status['Err']})")
             
             if not status or not isinstance(status, dict):
                 logger.warning(f"{device_id}: Invalid status response")
@@ -200,123 +422,180 @@ async def get_device_metrics(device: tinytuya.Device, device_id: str, retries: i
                 logger.debug(f"{device_id}: No DPS data")
                 return []
             
+            if plan is None:
+                plan = _metric_plan(device_id)
             metrics = []
-            # Use device ID as stable identifier, get friendly name from persistence
-            friendly_name = get_device_name(device_id)
-            device_name = format_device_name(friendly_name)
-            base = f"{config.METRIC_PREFIX}.tuya.{device_name}"
-            
-            # Common DPS mappings (may vary by device):
-            # 1: switch (on/off)
-            # 18: current (mA)
-            # 19: power (W * 10)
-            # 20: voltage (V * 10)
-            
-            # On/off state (DPS 1)
-            if '1' in dps:
-                is_on = 1 if dps['1'] else 0
-                metrics.append((f"{base}.is_on", is_on))
-            
-            # Power (DPS 19 or 4 or 6)
-            for dps_id in ['19', '4', '6']:
-                power_raw = dps.get(dps_id)
-                if power_raw is not None:
-                    power = _metric_scaler.normalize_by_dps(device_id, dps_id, power_raw)
-                    if power is not None:
-                        metrics.append((f"{base}.power_watts", power))
-                    break
-            
-            # Voltage (DPS 20)
-            voltage_raw = dps.get('20')
-            if voltage_raw is not None:
-                voltage = _metric_scaler.normalize_by_dps(device_id, '20', voltage_raw)
-                if voltage is not None:
-                    metrics.append((f"{base}.voltage_volts", voltage))
-            
-            # Current (DPS 18)
-            current_raw = dps.get('18')
-            if current_raw is not None:
-                current = _metric_scaler.normalize_by_dps(device_id, '18', current_raw)
-                if current is not None:
-                    metrics.append((f"{base}.current_amps", current))
+            for dps_ids, metric_name, normalise in plan.entries:
+                for dps_id in dps_ids:
+                    raw = dps.get(dps_id)
+                    if raw is not None:
+                        value = normalise(dps_id, raw)
+                        if value is not None:
+                            metrics.append((metric_name, value))
+                        break
             
             logger.debug(f"Collected {len(metrics)} metrics from {device_id}")
             if metrics:
                 _mark_local_success(device_id)
             return metrics
             
-        except asyncio.TimeoutError:
-            if attempt < retries:
-                wait_time = min(2 ** attempt, 10)
-                logger.warning(f"{device_id} timeout ({attempt}/{retries}). Retrying in {wait_time}s...")
-                await asyncio.sleep(wait_time)
-            else:
-                logger.error(f"{device_id} failed after {retries} timeout attempts")
+        except TimeoutError:
+            error = "timeout"
+        except OSError as e:
+            if isinstance(e, ConnectionError):
+                # The persistent socket went stale; drop it so the next
+                # attempt reconnects.
+                device.close()
+            error = f"network error: {e}"
         except Exception as e:
-            if attempt < retries:
-                wait_time = min(2 ** attempt, 10)
-                logger.warning(f"{device_id} error ({attempt}/{retries}): {e}. Retrying in {wait_time}s...")
-                await asyncio.sleep(wait_time)
-            else:
-                logger.error(f"{device_id} failed after {retries} attempts: {e}")
+            # Malformed replies (ValueError, KeyError, ...) won't fix
+            # themselves on retry.
+            logger.error(f"{device_id} failed: {e}")
+            return []
+        
+        if attempt < retries:
+            logger.warning(f"{device_id} {error} ({attempt}/{retries}). Retrying...")
+            await _backoff(attempt)
+        else:
+            logger.error(f"{device_id} failed after {retries} attempts ({error})")
     
     return []
 
 
-def _build_devices(devices_info: Dict[str, Dict[str, Any]]) -> Dict[str, tinytuya.Device]:
-    """Build tinytuya.Device objects from scan results."""
+def _build_device(dev_id: str, dev_info: Dict[str, Any]) -> tinytuya.Device:
+    """Build one tinytuya.Device with this script's socket settings."""
+    dev = tinytuya.Device(
+        dev_id=dev_id,
+        address=dev_info.get('ip'),
+        local_key=dev_info.get('key', ''),
+        version=dev_info.get('version', '3.3')
+    )
+    dev.set_socketPersistent(True)
+    dev.set_socketRetryLimit(1)
+    dev.set_socketTimeout(5)
+    return dev
+
+
+def _same_endpoint(dev: tinytuya.Device, dev_info: Dict[str, Any]) -> bool:
+    """True if an existing Device already talks to the address/key/version in dev_info."""
+    # On v3.4/3.5 tinytuya swaps local_key for the negotiated session key;
+    # real_local_key keeps the configured one.
+    return (
+        dev.address == dev_info.get('ip')
+        and dev.real_local_key == (dev_info.get('key') or '').encode('latin1')
+        and str(dev.version) == str(dev_info.get('version', '3.3'))
+    )
+
+
+def _build_devices(devices_info: Dict[str, Dict[str, Any]],
+                   existing: Optional[Dict[str, tinytuya.Device]] = None,
+                   ) -> Tuple[Dict[str, tinytuya.Device], Dict[str, DeviceMetricPlan]]:
+    """Build tinytuya.Device objects and their metric plans from scan results.
+
+    Devices keep a persistent socket so the TCP connect and Tuya session
+    negotiation happen once rather than on every poll. The address must be
+    the concrete IP from the scan: with address='Auto' tinytuya re-runs
+    discovery on reconnect and can hit "Address already in use". Devices
+    in existing whose endpoint is unchanged are reused, open socket and all.
+
+    Construction is blocking, so async callers run this via asyncio.to_thread
+    and then pass the plans to _install_metric_plans back on the event loop.
+    """
+    existing = existing or {}
     devices = {}
+    plans = {}
     for dev_id, dev_info in devices_info.items():
         try:
-            devices[dev_id] = tinytuya.Device(
-                dev_id=dev_id,
-                address=dev_info.get('ip'),
-                local_key=dev_info.get('key', ''),
-                version=dev_info.get('version', '3.3')
-            )
+            dev = existing.get(dev_id)
+            if dev is None or not _same_endpoint(dev, dev_info):
+                dev = _build_device(dev_id, dev_info)
+            devices[dev_id] = dev
+            plans[dev_id] = _build_metric_plan(dev_id)
         except Exception as e:
             logger.warning(f"Could not create device {dev_id}: {e}")
-    return devices
+    return devices, plans
 
 
-async def poll_devices_once(devices: Dict[str, tinytuya.Device]) -> int:
+async def poll_devices_once(devices: Dict[str, tinytuya.Device],
+                            send_queue: Optional[CarbonSendQueue] = None) -> int:
     """
     Poll all devices once and send metrics to Graphite
-    Uses asyncio.gather with return_exceptions to isolate device failures
+    Each device runs in its own task so one failure cannot affect the others,
+    and sends its metrics as soon as its own poll completes
     
     Args:
         devices: Dictionary of device_id -> Device
+        send_queue: If given, metrics are queued for its sender task instead
+            of being sent inline, so a slow Carbon cannot delay the poll
         
     Returns:
-        Number of metrics sent
+        Number of metrics sent (or queued)
     """
     if not devices:
         logger.warning("No Tuya devices to poll")
         return 0
     
-    # Poll all devices concurrently with isolated error handling
-    tasks = [get_device_metrics(dev, dev_id) for dev_id, dev in devices.items()]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    all_metrics = []
-    for result in results:
-        if isinstance(result, Exception):
-            logger.error(f"Device polling task error: {result}")
-        elif isinstance(result, list):
-            all_metrics.extend(result)
+    # One timestamp for the whole cycle so Graphite sees a coherent snapshot
+    timestamp = int(time.time())
+    keepalive = getattr(config, 'METRIC_KEEPALIVE_POLLS', 60)
+    _deduper.start_poll()
+    client = get_carbon_client(
+        config.CARBON_SERVER, config.CARBON_PORT, getattr(config, 'CARBON_PICKLE_PORT', None)
+    )
     
-    if not all_metrics:
-        logger.warning("No Tuya metrics collected")
-        return 0
+    async def _poll_and_send(dev_id: str, dev: tinytuya.Device) -> Tuple[int, int]:
+        """Poll one device and send its metrics as soon as they arrive.
+        
+        Sends share the persistent Carbon connection, so a slow plug no
+        longer holds back every other plug's readings.
+        """
+        result = await get_device_metrics(dev, dev_id, plan=_metric_plan(dev_id))
+        _record_poll_result(dev_id, bool(result))
+        metrics = [
+            (name, value) for name, value in result
+            if name.endswith(_ALWAYS_SENT_SUFFIX) or _deduper.should_emit(name, value, keepalive)
+        ]
+        if not metrics:
+            return len(result), 0
+        if send_queue is not None:
+            return len(result), send_queue.put(metrics, timestamp)
+        try:
+            return len(result), await client.send(metrics, timestamp)
+        except Exception as e:
+            logger.error(f"Failed to send metrics for {dev_id} to Graphite: {e}")
+            return len(result), 0
     
-    # Send all metrics to Graphite
+    # Poll all devices concurrently with isolated error handling; the
+    # semaphore caps how many blocking status() calls are in flight.
+    _poll_semaphore(len(devices))
+    tasks = [asyncio.create_task(_poll_and_send(dev_id, dev)) for dev_id, dev in devices.items()]
     try:
-        count = send_metrics(config.CARBON_SERVER, config.CARBON_PORT, all_metrics)
-        logger.info(f"Sent {count} Tuya metrics to Graphite")
-        return count
-    except Exception as e:
-        logger.error(f"Failed to send metrics to Graphite: {e}")
-        return 0
+        await asyncio.wait(tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    
+    collected = sent = 0
+    for dev_id, task in zip(devices, tasks):
+        if task.cancelled():
+            continue
+        error = task.exception()
+        if error is not None:
+            logger.error(f"Device polling task error: {error}")
+            _record_poll_result(dev_id, False)
+        else:
+            device_collected, device_sent = task.result()
+            collected += device_collected
+            sent += device_sent
+    
+    if not collected:
+        logger.warning("No Tuya metrics collected")
+    elif sent:
+        logger.info(f"{'Queued' if send_queue is not None else 'Sent'} {sent} Tuya metrics for Graphite")
+    else:
+        logger.debug(f"No Tuya metrics sent ({collected} collected)")
+    return sent
 
 
 async def discover_and_print():
@@ -348,75 +627,319 @@ async def poll_once():
         print("No Tuya devices found.")
         return
     
-    devices = _build_devices(devices_info)
+    devices, plans = await asyncio.to_thread(_build_devices, devices_info)
+    _install_metric_plans(plans)
     print("\nPolling Tuya devices...")
     count = await poll_devices_once(devices)
     print(f"\nSent {count} metrics to Graphite at {config.CARBON_SERVER}:{config.CARBON_PORT}")
 
 
+# Tuya devices broadcast their gwId/IP/version every few seconds on UDP
+# 6666 (v3.1, plaintext) and 6667 (v3.3+, encrypted). Listening to these
+# continuously picks up new devices and IP changes within seconds, so the
+# blocking ~15 s deviceScan is only needed as a fallback.
+_UDP_DISCOVERY_PORTS = (tinytuya.UDPPORT, tinytuya.UDPPORTS)
+
+
+def _open_udp_discovery_sockets() -> List[socket.socket]:
+    """Bind non-blocking listeners on the Tuya broadcast ports ([] if unavailable)."""
+    if not hasattr(tinytuya, 'decrypt_udp'):
+        return []
+    sockets = []
+    try:
+        for port in _UDP_DISCOVERY_PORTS:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            # deviceScan binds the same ports when a fallback scan runs
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', port))
+            sock.setblocking(False)
+    except OSError as e:
+        logger.warning(f"Cannot listen for Tuya UDP broadcasts ({e}); using periodic scans")
+        for sock in sockets:
+            sock.close()
+        return []
+    return sockets
+
+
+def _load_device_keys() -> Dict[str, Dict[str, Any]]:
+    """Map device ID -> devices.json entry, for the local key and name."""
+    try:
+        with open(DEVICES_JSON_PATH, 'rb') as f:
+            data = json_loads(f.read())
+    except Exception as e:
+        logger.warning(f"Could not load Tuya device keys from {DEVICES_JSON_PATH}: {e}")
+        return {}
+    if isinstance(data, dict):
+        data = data.get('devices', [])
+    return {entry['id']: entry for entry in data if isinstance(entry, dict) and entry.get('id')}
+
+
+def _parse_broadcast(packet: bytes) -> Optional[Dict[str, Any]]:
+    """Decode a Tuya discovery broadcast, or return None if it is not one."""
+    try:
+        info = json_loads(tinytuya.decrypt_udp(packet))
+    except Exception:
+        return None
+    if not isinstance(info, dict) or not info.get('gwId') or not info.get('ip'):
+        return None
+    return info
+
+
+def _build_announced_device(dev_id: str, dev_info: Dict[str, Any],
+                            ) -> Tuple[tinytuya.Device, DeviceMetricPlan]:
+    """Build a device and its metric plan for _apply_broadcast (blocking).
+
+    The friendly name is registered before the plan is built, so the device
+    never becomes visible to the poller with a raw-ID metric path.
+    """
+    dev = _build_device(dev_id, dev_info)
+    get_device_name(dev_id, fallback_name=dev_info['name'])
+    return dev, _build_metric_plan(dev_id)
+
+
+async def _apply_broadcast(info: Dict[str, Any], devices: Dict[str, tinytuya.Device],
+                           devices_lock: asyncio.Lock, device_keys: Dict[str, Dict[str, Any]]) -> None:
+    """Add or re-address a device from a discovery broadcast.
+
+    Broadcasts for devices already polled at the announced IP/version (the
+    steady state) are ignored, as are devices without a key in devices.json.
+    """
+    dev_id = info['gwId']
+    ip = info['ip']
+    version = str(info.get('version') or '3.3')
+    old = devices.get(dev_id)
+    if old is not None and old.address == ip and str(old.version) == version:
+        return
+    entry = device_keys.get(dev_id)
+    if entry is None:
+        return
+
+    dev_info = {
+        'ip': ip,
+        'name': entry.get('name', dev_id),
+        'key': entry.get('key', ''),
+        'version': version,
+        'mac': entry.get('mac', ''),
+    }
+    try:
+        dev, plan = await asyncio.to_thread(_build_announced_device, dev_id, dev_info)
+    except Exception as e:
+        logger.warning(f"Could not create device {dev_id}: {e}")
+        return
+    async with devices_lock:
+        old = devices.get(dev_id)
+        devices[dev_id] = dev
+        _METRIC_PLANS[dev_id] = plan
+        if old is not None:
+            _retire_device(old)
+    if old is None:
+        logger.info(f"Tuya device {dev_id} announced at {ip}; now polling")
+    else:
+        logger.info(f"Tuya device {dev_id} moved from {old.address} to {ip}")
+    await asyncio.to_thread(_save_device_cache, {**_load_device_cache(), dev_id: dev_info})
+
+
+async def _udp_discovery_loop(sockets: List[socket.socket], devices: Dict[str, tinytuya.Device],
+                              devices_lock: asyncio.Lock) -> None:
+    """Apply Tuya discovery broadcasts to the polled device dict as they arrive."""
+    loop = asyncio.get_running_loop()
+    device_keys = await asyncio.to_thread(_load_device_keys)
+
+    async def _listen(sock: socket.socket) -> None:
+        while True:
+            try:
+                packet = await loop.sock_recv(sock, 4096)
+            except OSError as e:
+                logger.warning(f"Tuya UDP listener error: {e}")
+                await asyncio.sleep(1)
+                continue
+            info = _parse_broadcast(packet)
+            if info is not None:
+                await _apply_broadcast(info, devices, devices_lock, device_keys)
+
+    try:
+        await asyncio.gather(*(_listen(sock) for sock in sockets))
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+# Devices dropped from the polled dict. The poller may still be inside
+# their status() on a pool thread (it polls a snapshot), so they are only
+# closed by _poll_forever at the start of its next cycle. Guarded by the
+# devices lock.
+_RETIRED_DEVICES: List[tinytuya.Device] = []
+
+
+def _retire_device(dev: tinytuya.Device) -> None:
+    """Queue a replaced device to be closed once no poll can be using it."""
+    _RETIRED_DEVICES.append(dev)
+
+
+def _close_retired_devices() -> None:
+    """Close retired devices; call only between poll cycles."""
+    while _RETIRED_DEVICES:
+        dev = _RETIRED_DEVICES.pop()
+        try:
+            dev.close()
+        except Exception as e:
+            logger.debug(f"Error closing retired Tuya device: {e}")
+
+
+async def _poll_forever(devices: Dict[str, tinytuya.Device], devices_lock: asyncio.Lock,
+                        rescan_requested: asyncio.Event, send_queue: Optional[CarbonSendQueue] = None) -> None:
+    """Poll the current device set every SMART_PLUG_POLL_INTERVAL seconds.
+
+    Requests an early re-scan if no device answers for several consecutive
+    polls. This is judged by devices answering rather than metrics sent,
+    since deduplication can leave a healthy fleet with nothing to send.
+    """
+    failed_polls = 0  # Track consecutive failed polls
+    while True:
+        try:
+            async with devices_lock:
+                current = dict(devices)
+                # The previous cycle has finished, so nothing retired
+                # before this snapshot is still in use.
+                _close_retired_devices()
+            
+            # Poll devices if we have any
+            if current:
+                await poll_devices_once(current, send_queue)
+                if all(dev_id in _DEVICE_FAILURES for dev_id in current):
+                    failed_polls += 1
+                    # If no device has answered in 3 polls, try re-scanning
+                    if failed_polls >= 3:
+                        logger.warning(f"No Tuya device answered for {failed_polls} polls - triggering re-scan")
+                        rescan_requested.set()
+                        failed_polls = 0
+                else:
+                    failed_polls = 0  # Reset counter on successful poll
+            else:
+                logger.warning("No Tuya devices available to poll")
+            
+        except Exception as e:
+            log_loop_error(logger, "Error in main loop iteration", e)
+        
+        # Sleep until next poll
+        await asyncio.sleep(config.SMART_PLUG_POLL_INTERVAL)
+
+
+async def _refresh_devices(devices: Dict[str, tinytuya.Device], devices_lock: asyncio.Lock,
+                           devices_info: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+    """Scan (unless devices_info is given) and rebuild the device dict in place.
+
+    The dict keeps its identity so every task holding it sees the new set.
+    Unchanged devices keep their Device object (and persistent socket);
+    replaced or vanished ones are retired, to be closed once any in-flight
+    poll is done with them. An empty scan leaves the current devices alone.
+    """
+    if devices_info is None:
+        devices_info = await scan_for_devices()
+    async with devices_lock:
+        old_devices = dict(devices)
+    new_devices, plans = await asyncio.to_thread(_build_devices, devices_info, old_devices)
+    if new_devices:
+        async with devices_lock:
+            for dev_id, dev in devices.items():
+                if new_devices.get(dev_id) is not dev:
+                    _retire_device(dev)
+            devices.clear()
+            devices.update(new_devices)
+            _install_metric_plans(plans)
+        logger.info(f"Updated device list: {len(new_devices)} devices")
+
+
+# While every known device answers its polls, periodic scans are stretched
+# to this many scan intervals; a deviceScan blocks for 10+ seconds and the
+# healthy fleet has nothing for it to find.
+_HEALTHY_RESCAN_FACTOR = 4
+
+
+def _all_devices_healthy(devices: Dict[str, tinytuya.Device]) -> bool:
+    """True if there are devices and none of them failed its most recent poll."""
+    return bool(devices) and not any(dev_id in _DEVICE_FAILURES for dev_id in devices)
+
+
+async def _rescan_forever(devices: Dict[str, tinytuya.Device], devices_lock: asyncio.Lock,
+                          rescan_requested: asyncio.Event, scan_interval: Optional[float]) -> None:
+    """Re-scan every scan_interval seconds, or sooner when a re-scan is requested.
+
+    With scan_interval=None only requested scans run. Periodic scans are
+    skipped while all devices are healthy, up to _HEALTHY_RESCAN_FACTOR
+    intervals since the last scan. The device dict is updated in place so
+    the poller sees the new set.
+    """
+    last_scan = time.monotonic()
+    while True:
+        try:
+            await asyncio.wait_for(rescan_requested.wait(), timeout=scan_interval)
+            reason = "requested"
+        except asyncio.TimeoutError:
+            reason = "periodic scan"
+            if (_all_devices_healthy(devices)
+                    and time.monotonic() - last_scan < scan_interval * _HEALTHY_RESCAN_FACTOR):
+                logger.debug("Skipping periodic rescan, all devices healthy")
+                continue
+        rescan_requested.clear()
+        last_scan = time.monotonic()
+        
+        try:
+            logger.info(f"Re-scanning for Tuya devices ({reason})...")
+            await _refresh_devices(devices, devices_lock)
+        except Exception as e:
+            log_loop_error(logger, "Error re-scanning for Tuya devices", e)
+
+
 async def main_loop():
     """
     Main monitoring loop - scan for devices and poll continuously
     Robust: continues running even if scan or polling fails
+
+    Polling and re-scanning run as separate tasks so scan cadence is
+    independent of poll cadence. While the UDP broadcast listener is up,
+    full scans only run at startup and when polls keep failing.
     """
     logger.info("Starting Tuya Local LAN to Graphite monitoring")
     logger.info(f"Graphite server: {config.CARBON_SERVER}:{config.CARBON_PORT}")
     logger.info(f"Poll interval: {config.SMART_PLUG_POLL_INTERVAL} seconds")
     
-    # Initial scan
-    devices_info = await scan_for_devices()
-    devices = _build_devices(devices_info)
+    scan_interval = getattr(config, "TUYA_REDISCOVERY_INTERVAL", 180)  # Re-scan every N minutes
+    devices_lock = asyncio.Lock()
+    rescan_requested = asyncio.Event()
+    
+    # Start from the cached device table if we have one and refresh it with
+    # a background scan; otherwise block on an initial scan.
+    devices: Dict[str, tinytuya.Device] = {}
+    devices_info = _load_device_cache()
+    if devices_info:
+        logger.info(f"Loaded {len(devices_info)} Tuya device(s) from cache; scanning in background")
+        rescan_requested.set()
+    await _refresh_devices(devices, devices_lock, devices_info or None)
     
     if not devices:
         logger.warning("No Tuya devices found initially. Will retry scan in main loop...")
     
-    # Main loop - never exit except on KeyboardInterrupt
-    last_scan = time.time()
-    scan_interval = getattr(config, "TUYA_REDISCOVERY_INTERVAL", 180)  # Re-scan every N minutes
-    failed_polls = 0  # Track consecutive failed polls
+    # Polls hand metrics to a queue drained by its own sender task, so a
+    # slow or unreachable Carbon never delays the next poll.
+    send_queue = CarbonSendQueue(get_carbon_client(
+        config.CARBON_SERVER, config.CARBON_PORT, getattr(config, 'CARBON_PICKLE_PORT', None)
+    ))
+    tasks = [send_queue.run(), _poll_forever(devices, devices_lock, rescan_requested, send_queue)]
+    udp_sockets = _open_udp_discovery_sockets()
+    if udp_sockets:
+        logger.info("Listening for Tuya UDP broadcasts; periodic scans disabled")
+        tasks.append(_udp_discovery_loop(udp_sockets, devices, devices_lock))
+        scan_interval = None
+    tasks.append(_rescan_forever(devices, devices_lock, rescan_requested, scan_interval))
     
+    # Main loop - never exit except on KeyboardInterrupt
     try:
-        while True:
-            try:
-                # Poll devices if we have any
-                if devices:
-                    metrics_sent = await poll_devices_once(devices)
-                    if metrics_sent == 0:
-                        failed_polls += 1
-                        # If we haven't sent metrics in 3 polls, try re-scanning
-                        if failed_polls >= 3:
-                            logger.warning(f"No metrics sent for {failed_polls} polls - triggering re-scan")
-                            devices_info = await scan_for_devices()
-                            new_devices = _build_devices(devices_info)
-                            if new_devices:
-                                devices = new_devices
-                                logger.info(f"Updated device list after failed polls: {len(devices)} devices")
-                            
-                            failed_polls = 0
-                            last_scan = time.time()
-                    else:
-                        failed_polls = 0  # Reset counter on successful poll
-                else:
-                    logger.warning("No Tuya devices available to poll")
-                
-                # Re-scan periodically
-                if time.time() - last_scan >= scan_interval:
-                    logger.info("Re-scanning for Tuya devices (periodic scan)...")
-                    devices_info = await scan_for_devices()
-                    new_devices = _build_devices(devices_info)
-                    if new_devices:
-                        devices = new_devices
-                        logger.info(f"Updated device list: {len(devices)} devices")
-                    
-                    failed_polls = 0
-                    last_scan = time.time()
-                
-            except Exception as e:
-                logger.error(f"Error in main loop iteration: {e}", exc_info=True)
-            
-            # Sleep until next poll
-            await asyncio.sleep(config.SMART_PLUG_POLL_INTERVAL)
-            
+        await asyncio.gather(*tasks)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
 
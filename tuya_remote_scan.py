@@ -3,7 +3,11 @@
 Helper to scan for Tuya devices on a remote subnet via SSH
 """
 
+import asyncio
+import ipaddress
 import json
+import socket
+import struct
 import subprocess
 import logging
 import os
@@ -11,6 +15,40 @@ from typing import Dict, List, Optional
 
 logger = logging.getLogger(__name__)
 
+TUYA_PORT = 6668
+# Refuse to probe anything bigger than a /22's worth of hosts
+MAX_SCAN_HOSTS = 1024
+
+
+def _subnet_hosts(subnet: str) -> List[str]:
+    """Return the host addresses in subnet (any prefix length).
+
+    Raises ValueError for an invalid subnet or one with more than
+    MAX_SCAN_HOSTS hosts.
+    """
+    network = ipaddress.ip_network(subnet, strict=False)
+    if network.num_addresses > MAX_SCAN_HOSTS + 2:
+        raise ValueError(f"{subnet} has more than {MAX_SCAN_HOSTS} hosts")
+    return [str(ip) for ip in network.hosts()]
+
+
+def _ssh_base_cmd(ssh_identity: Optional[str] = None, use_sshpass: bool = False,
+                  password_env_var: str = 'OPENWRT_PASSWORD') -> List[str]:
+    """Build the ssh (or sshpass + ssh) argv prefix shared by both scanners."""
+    ssh_cmd = []
+
+    # Use sshpass if enabled and password is available
+    if use_sshpass and password_env_var in os.environ:
+        ssh_cmd = ['sshpass', '-e']
+        # Set SSH_ASKPASS environment variable name for sshpass
+        os.environ['SSHPASS'] = os.environ[password_env_var]
+
+    ssh_cmd.extend(['ssh'])
+    if ssh_identity:
+        ssh_cmd.extend(['-i', ssh_identity])
+    ssh_cmd.extend(['-o', 'StrictHostKeyChecking=no', '-o', 'ConnectTimeout=5'])
+    return ssh_cmd
+
 
 def scan_remote_subnet(ssh_host: str, subnet: str = '192.168.1.0/24', ssh_identity: Optional[str] = None, use_sshpass: bool = False, password_env_var: str = 'OPENWRT_PASSWORD') -> List[str]:
     """
@@ -26,33 +64,31 @@ def scan_remote_subnet(ssh_host: str, subnet: str = '192.168.1.0/24', ssh_identi
     Returns:
         List of IP addresses where Tuya devices were found
     """
+    try:
+        hosts = _subnet_hosts(subnet)
+    except ValueError as e:
+        logger.error(f"Invalid subnet {subnet}: {e}")
+        return []
+    
     try:
         # Build SSH command
-        ssh_cmd = []
-        
-        # Use sshpass if enabled and password is available
-        if use_sshpass and password_env_var in os.environ:
-            ssh_cmd = ['sshpass', '-e']
-            # Set SSH_ASKPASS environment variable name for sshpass
-            os.environ['SSHPASS'] = os.environ[password_env_var]
-        
-        ssh_cmd.extend(['ssh'])
-        if ssh_identity:
-            ssh_cmd.extend(['-i', ssh_identity])
-        ssh_cmd.extend(['-o', 'StrictHostKeyChecking=no', '-o', 'ConnectTimeout=5'])
+        ssh_cmd = _ssh_base_cmd(ssh_identity, use_sshpass, password_env_var)
         ssh_cmd.append(ssh_host)
         
-        # Scan for devices on port 6668 (Tuya default)
+        # Scan for devices on port 6668 (Tuya default). The host list is
+        # computed here and fed on stdin, so any prefix length works.
         # Use nmap if available, otherwise try netcat scan
         remote_cmd = f"""
         # Try nmap first
         if command -v nmap >/dev/null 2>&1; then
-            nmap -p 6668 --open {subnet} 2>/dev/null | grep 'Nmap scan report for' | awk '{{print $NF}}' | tr -d '()'
+            nmap -n -p {TUYA_PORT} --open -iL - 2>/dev/null | grep 'Nmap scan report for' | awk '{{print $NF}}' | tr -d '()'
         else
-            # Fallback: scan common IPs with nc
-            for i in $(seq 1 254); do
-                ip="{subnet.rsplit('.', 1)[0]}.$i"
-                timeout 0.2 nc -z -w 1 "$ip" 6668 2>/dev/null && echo "$ip" &
+            # Fallback: probe with nc, 32 at a time
+            n=0
+            while read -r ip; do
+                (timeout 0.2 nc -z -w 1 "$ip" {TUYA_PORT} 2>/dev/null && echo "$ip") &
+                n=$((n + 1))
+                [ $((n % 32)) -eq 0 ] && wait
             done
             wait
         fi
@@ -61,7 +97,8 @@ def scan_remote_subnet(ssh_host: str, subnet: str = '192.168.1.0/24', ssh_identi
         ssh_cmd.append(remote_cmd)
         
         logger.debug(f"Scanning {subnet} via {ssh_host}...")
-        result = subprocess.run(ssh_cmd, capture_output=True, text=True, timeout=30)
+        result = subprocess.run(ssh_cmd, input='\n'.join(hosts) + '\n',
+                                capture_output=True, text=True, timeout=30)
         
         if result.returncode != 0:
             logger.warning(f"Remote scan command failed: {result.stderr}")
@@ -82,3 +119,104 @@ def scan_remote_subnet(ssh_host: str, subnet: str = '192.168.1.0/24', ssh_identi
     except Exception as e:
         logger.error(f"Error scanning remote subnet {subnet}: {e}")
         return []
+
+
+async def _socks5_probe(proxy_port: int, ip: str, port: int = TUYA_PORT, timeout: float = 0.5) -> bool:
+    """Return True if ip:port accepts a TCP connection through a local SOCKS5 proxy."""
+    writer = None
+    try:
+        async with asyncio.timeout(timeout):
+            reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+            # Greeting: version 5, one auth method, "no authentication"
+            writer.write(b'\x05\x01\x00')
+            if await reader.readexactly(2) != b'\x05\x00':
+                return False
+            # CONNECT to an IPv4 address
+            writer.write(b'\x05\x01\x00\x01' + socket.inet_aton(ip) + struct.pack('!H', port))
+            reply = await reader.readexactly(10)
+            return reply[1] == 0
+    except (OSError, TimeoutError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def _wait_for_port(port: int, proc: asyncio.subprocess.Process, timeout: float = 10.0) -> bool:
+    """Wait until the SSH SOCKS listener accepts connections (or ssh exits)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline and proc.returncode is None:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.2)
+            continue
+        writer.close()
+        return True
+    return False
+
+
+def _free_local_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def scan_remote_subnet_async(ssh_host: str, subnet: str = '192.168.1.0/24', ssh_identity: Optional[str] = None,
+                                   use_sshpass: bool = False, password_env_var: str = 'OPENWRT_PASSWORD',
+                                   probe_timeout: float = 0.5, concurrency: int = 32) -> List[str]:
+    """
+    Scan a remote subnet for Tuya devices through one SSH SOCKS tunnel
+
+    Opens a single `ssh -D` dynamic forward and probes every host's port
+    6668 concurrently from Python, instead of running a shell loop on the
+    router. Falls back to scan_remote_subnet if the tunnel cannot be set up.
+
+    Returns:
+        List of IP addresses where Tuya devices were found
+    """
+    try:
+        hosts = _subnet_hosts(subnet)
+    except ValueError as e:
+        logger.error(f"Invalid subnet {subnet}: {e}")
+        return []
+
+    proxy_port = _free_local_port()
+    ssh_cmd = _ssh_base_cmd(ssh_identity, use_sshpass, password_env_var)
+    ssh_cmd.extend(['-o', 'ExitOnForwardFailure=yes', '-N', '-D', f'127.0.0.1:{proxy_port}', ssh_host])
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *ssh_cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        )
+    except OSError as e:
+        logger.warning(f"Could not start SSH tunnel to {ssh_host} ({e}); using shell scan")
+        return await asyncio.to_thread(scan_remote_subnet, ssh_host, subnet, ssh_identity, use_sshpass, password_env_var)
+
+    try:
+        if not await _wait_for_port(proxy_port, proc):
+            logger.warning(f"SSH tunnel to {ssh_host} did not come up; using shell scan")
+            return await asyncio.to_thread(scan_remote_subnet, ssh_host, subnet, ssh_identity, use_sshpass, password_env_var)
+
+        logger.debug(f"Scanning {subnet} via SOCKS tunnel to {ssh_host}...")
+        sem = asyncio.Semaphore(concurrency)
+
+        async def probe(ip: str) -> bool:
+            async with sem:
+                return await _socks5_probe(proxy_port, ip, timeout=probe_timeout)
+
+        found = await asyncio.gather(*(probe(ip) for ip in hosts))
+        ips = [ip for ip, ok in zip(hosts, found) if ok]
+        if ips:
+            logger.info(f"Found {len(ips)} potential Tuya device(s) on {subnet}: {ips}")
+        else:
+            logger.debug(f"No Tuya devices found on {subnet}")
+        return ips
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                proc.kill()
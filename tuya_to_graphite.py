@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Tuya (local LAN + cloud) to Graphite Integration
+Runs the local and cloud Tuya pollers in one process so they share a single
+event loop, thread pool and persistent Carbon connection.
+
+Usage:
+    python tuya_to_graphite.py [--once]
+
+The standalone tuya_local_to_graphite.py / tuya_cloud_to_graphite.py scripts
+still work; run either those two or this one, not both.
+"""
+
+import asyncio
+import logging
+import argparse
+
+import tuya_cloud_to_graphite
+import tuya_local_to_graphite
+
+logger = logging.getLogger(__name__)
+
+
+async def poll_once():
+    """Run one local and one cloud poll cycle."""
+    await tuya_local_to_graphite.poll_once()
+    await tuya_cloud_to_graphite.poll_once()
+
+
+async def main_loop():
+    """
+    Main monitoring loop - run both Tuya pollers as tasks on one event loop
+    Each poller handles its own errors; if one exits unexpectedly the group
+    is torn down so the service manager restarts the whole process.
+    """
+    logger.info("Starting combined Tuya local + cloud to Graphite monitoring")
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(tuya_local_to_graphite.main_loop(), name='tuya-local')
+            tg.create_task(tuya_cloud_to_graphite.main_loop(), name='tuya-cloud')
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tuya Local + Cloud to Graphite Integration')
+    parser.add_argument('--once', action='store_true', help='Poll once and exit (for testing)')
+    args = parser.parse_args()
+
+    if args.once:
+        asyncio.run(poll_once())
+    else:
+        asyncio.run(main_loop())
+
+
+if __name__ == '__main__':
+    main()